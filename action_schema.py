@@ -0,0 +1,84 @@
+"""Structured (JSON) replies of the main agent.
+
+With `--structured_output` the main calls send `ACTION_SCHEMA` as the Gemini
+response schema, so the reply is a JSON object (thought, action, element,
+text) instead of free text. `structured_reply_to_text` turns it back into the
+usual "Thought: ...\nAction: Click [5]" form. The history, EGA, trajectory and
+`extract_information` then work on the same text as in the free-text mode.
+A reply that is not valid JSON for the schema goes through the regex path
+unchanged.
+"""
+import json
+
+ACTION_TYPES = ["click", "type", "scroll", "wait", "goback", "google", "select", "generatetext", "answer"]
+
+ACTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "thought": {"type": "STRING", "description": "Brief thoughts, summarize the info that will help ANSWER"},
+        "action": {"type": "STRING", "enum": ACTION_TYPES},
+        "element": {"type": "STRING", "description": "Numerical label of the web element, or WINDOW for a window scroll"},
+        "text": {"type": "STRING", "description": "Content to type, up/down for Scroll, option for Select, prompt for GenerateText, answer for ANSWER"},
+    },
+    "required": ["thought", "action"],
+    "property_ordering": ["thought", "action", "element", "text"],
+}
+
+# actions that need a numerical label, and those that need text
+_NEEDS_ELEMENT = {"click", "type", "select"}
+_NEEDS_TEXT = {"type", "select", "generatetext", "answer"}
+
+
+def format_action(reply: dict) -> str | None:
+    """Action line for a schema reply, None when required fields are missing"""
+    action = reply.get("action")
+    element = str(reply.get("element") or "").strip().strip("[]")
+    text = str(reply.get("text") or "").strip()
+    if action not in ACTION_TYPES:
+        return None
+    if action in _NEEDS_ELEMENT and not element.isdigit():
+        return None
+    if action in _NEEDS_TEXT and not text:
+        return None
+    if action == "click":
+        return f"Click [{element}]"
+    if action == "type":
+        return f"Type [{element}]; [{text}]"
+    if action == "scroll":
+        direction = text.lower() if text.lower() in ("up", "down") else "down"
+        return f"Scroll [{element if element.isdigit() else 'WINDOW'}]; [{direction}]"
+    if action == "select":
+        return f"Select [{element}]; [{text}]"
+    if action == "generatetext":
+        return f"GenerateText; [{text}]"
+    if action == "answer":
+        return f"ANSWER; [{text}]"
+    return {"wait": "Wait", "goback": "GoBack", "google": "Google"}[action]
+
+
+def structured_reply_to_text(reply_text: str) -> str | None:
+    """"Thought: ...\nAction: ..." for a JSON reply, None when it does not fit the schema"""
+    try:
+        reply = json.loads(reply_text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(reply, dict):
+        return None
+    action = format_action(reply)
+    if action is None:
+        return None
+    thought = " ".join(str(reply.get("thought") or "").split())
+    return f"Thought: {thought}\nAction: {action}"
+
+
+def apply_structured_reply(google_response) -> bool:
+    """Replace the JSON text of a Gemini response by its Thought/Action form, in place.
+    Returns False (response unchanged) when the reply does not fit the schema."""
+    if google_response is None or not google_response.candidates:
+        return False
+    part = google_response.candidates[0].content.parts[0]
+    text = structured_reply_to_text(part.text)
+    if text is None:
+        return False
+    part.text = text
+    return True
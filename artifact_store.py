@@ -0,0 +1,168 @@
+"""Content-addressed store for result artifacts.
+
+Blobs are named by the sha256 of the original bytes and shared by every task
+that points at them, so a frame that shows up again (same page after a retry,
+the same landing page in another task) is stored once. Screenshots are
+re-encoded as lossless WebP (or optimized PNG) before they are written.
+
+Each task directory gets a `manifest.json` mapping its artifact names to
+blobs. Readers (`evaluation/auto_eval.py`, the API file endpoints) go through
+`list_task_artifacts` / `resolve_artifact`, which return nothing for task
+directories written without a store.
+"""
+import hashlib
+import io
+import os
+import threading
+
+from PIL import Image
+
+from utils_json import dump_json_file, load_json_file
+
+MANIFEST_NAME = "manifest.json"
+IMAGE_FORMATS = {
+    # format: (PIL format, save options, extension, mime type)
+    "webp": ("WEBP", {"lossless": True, "quality": 100, "method": 4}, "webp", "image/webp"),
+    "png": ("PNG", {"optimize": True}, "png", "image/png"),
+}
+
+
+class ArtifactStore:
+    def __init__(self, root: str, image_format: str = "webp"):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format {image_format}, expected one of {list(IMAGE_FORMATS)}")
+        self.root = os.path.abspath(root)
+        self.image_format = image_format
+        self._lock = threading.Lock()
+        self._known = set()
+        self._reset_stats()
+        os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+
+    def _reset_stats(self):
+        self._stats = {"blobs": 0, "dedup_hits": 0, "original_bytes": 0, "stored_bytes": 0}
+
+    def _blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join("blobs", digest[:2], f"{digest}.{ext}")
+
+    def _put(self, data: bytes, ext: str, encode=None) -> tuple[str, str, int]:
+        """Store `data` (encoded by `encode` if given) under its hash. Returns (digest, blob, size)."""
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self._blob_path(digest, ext)
+        path = os.path.join(self.root, blob)
+        with self._lock:
+            self._stats["original_bytes"] += len(data)
+            hit = blob in self._known or os.path.exists(path)
+        if hit:
+            size = os.path.getsize(path)
+            with self._lock:
+                self._known.add(blob)
+                self._stats["dedup_hits"] += 1
+            return digest, blob, size
+
+        payload = encode(data) if encode else data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # several runs may share a store, write under a private name then rename
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as fw:
+            fw.write(payload)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._known.add(blob)
+            self._stats["blobs"] += 1
+            self._stats["stored_bytes"] += len(payload)
+        return digest, blob, len(payload)
+
+    def _encode_image(self, data: bytes) -> bytes:
+        pil_format, options, _, _ = IMAGE_FORMATS[self.image_format]
+        image = Image.open(io.BytesIO(data))
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, **options)
+        return buffer.getvalue()
+
+    def put_image(self, png_bytes: bytes) -> dict:
+        _, _, ext, mime_type = IMAGE_FORMATS[self.image_format]
+        digest, blob, size = self._put(png_bytes, ext, self._encode_image)
+        return {"sha256": digest, "blob": blob, "mime_type": mime_type, "bytes": size, "original_bytes": len(png_bytes)}
+
+    def put_bytes(self, data: bytes, ext: str, mime_type: str) -> dict:
+        digest, blob, size = self._put(data, ext)
+        return {"sha256": digest, "blob": blob, "mime_type": mime_type, "bytes": size, "original_bytes": len(data)}
+
+    def get_bytes(self, blob: str) -> bytes:
+        with open(os.path.join(self.root, blob), "rb") as fr:
+            return fr.read()
+
+    def pop_stats(self) -> dict:
+        """Return the store statistics since the last call and reset them"""
+        with self._lock:
+            stats = dict(self._stats)
+            self._reset_stats()
+        return stats
+
+
+class TaskManifest:
+    """Artifacts of one task directory, saved to `manifest.json` after every change"""
+
+    def __init__(self, task_dir: str, store: ArtifactStore):
+        self.task_dir = task_dir
+        self.store = store
+        self.path = os.path.join(task_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.artifacts = []
+
+    def _add(self, name: str, entry: dict, **meta):
+        entry = {"name": name, **meta, **entry}
+        with self._lock:
+            self.artifacts = [a for a in self.artifacts if a["name"] != name] + [entry]
+            self._save()
+        return entry
+
+    def add_screenshot(self, step: int, png_bytes: bytes, suffix: str = "", kind: str = "screenshot") -> dict:
+        entry = self.store.put_image(png_bytes)
+        name = f"screenshot{step}{suffix}.{entry['blob'].rsplit('.', 1)[-1]}"
+        return self._add(name, entry, kind=kind, step=step)
+
+    def add_bytes(self, name: str, data: bytes, mime_type: str) -> dict:
+        entry = self.store.put_bytes(data, name.rsplit(".", 1)[-1], mime_type)
+        return self._add(name, entry)
+
+    def _save(self):
+        manifest = {
+            "store": os.path.relpath(self.store.root, os.path.abspath(self.task_dir)),
+            "artifacts": self.artifacts,
+        }
+        tmp_path = self.path + ".tmp"
+        dump_json_file(manifest, tmp_path, pretty=True)
+        os.replace(tmp_path, self.path)
+
+
+def load_manifest(task_dir: str) -> dict | None:
+    path = os.path.join(task_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    return load_json_file(path)
+
+
+def list_task_artifacts(task_dir: str) -> list[dict]:
+    """Manifest entries of `task_dir` with the absolute blob `path` filled in.
+
+    Entries whose blob is missing or escapes the store directory are dropped.
+    """
+    manifest = load_manifest(task_dir)
+    if not manifest:
+        return []
+    store_root = os.path.abspath(os.path.join(task_dir, manifest["store"]))
+    artifacts = []
+    for entry in manifest["artifacts"]:
+        path = os.path.abspath(os.path.join(store_root, entry["blob"]))
+        if not path.startswith(store_root + os.sep) or not os.path.exists(path):
+            continue
+        artifacts.append({**entry, "path": path})
+    return artifacts
+
+
+def resolve_artifact(task_dir: str, name: str) -> dict | None:
+    for entry in list_task_artifacts(task_dir):
+        if entry["name"] == name:
+            return entry
+    return None
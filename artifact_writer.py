@@ -0,0 +1,114 @@
+"""Background writer for per-step result artifacts.
+
+Screenshots, accessibility trees and transcripts are persisted from a single
+worker thread fed by a bounded queue, so the agent loop does not wait on disk
+while the LLM call is in flight. `submit` returns a Future for jobs whose
+completion matters (e.g. jobs that still use the browser).
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from utils_json import dump_json_file
+
+_STOP = object()
+
+
+class ArtifactWriter:
+    def __init__(self, max_queue_size: int = 64):
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self._reset_stats()
+        self._thread.start()
+
+    def _reset_stats(self):
+        self._stats = {
+            "jobs": 0,
+            "errors": 0,
+            "max_queue_depth": 0,
+            "total_lag": 0.0,
+            "max_lag": 0.0,
+            "blocked_time": 0.0,
+        }
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            name, fn, args, kwargs, future, submitted_at = item
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                logging.error(f"Artifact writer job {name} failed: {e}")
+                future.set_exception(e)
+                with self._lock:
+                    self._stats["errors"] += 1
+            finally:
+                # lag: time from submission until the artifact is on disk
+                lag = time.perf_counter() - submitted_at
+                with self._lock:
+                    self._stats["jobs"] += 1
+                    self._stats["total_lag"] += lag
+                    self._stats["max_lag"] = max(self._stats["max_lag"], lag)
+                self._queue.task_done()
+
+    def submit(self, name, fn, *args, **kwargs) -> Future:
+        future = Future()
+        start = time.perf_counter()
+        # blocks when the queue is full, the wait is recorded as back-pressure
+        self._queue.put((name, fn, args, kwargs, future, start))
+        blocked = time.perf_counter() - start
+        with self._lock:
+            self._stats["blocked_time"] += blocked
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        return future
+
+    def write_bytes(self, path, data: bytes) -> Future:
+        return self.submit(path, _write_bytes, path, data)
+
+    def write_text(self, path, text: str) -> Future:
+        return self.submit(path, _write_text, path, text)
+
+    def write_json(self, path, obj, pretty=False) -> Future:
+        return self.submit(path, dump_json_file, obj, path, pretty)
+
+    def flush(self):
+        """Block until every queued artifact has been written"""
+        self._queue.join()
+
+    def pop_stats(self) -> dict:
+        """Return the queue statistics since the last call and reset them"""
+        with self._lock:
+            stats = dict(self._stats)
+            self._reset_stats()
+        jobs = stats.pop("jobs")
+        total_lag = stats.pop("total_lag")
+        return {
+            "jobs": jobs,
+            "errors": stats["errors"],
+            "max_queue_depth": stats["max_queue_depth"],
+            "avg_lag_ms": round(total_lag / jobs * 1000, 2) if jobs else 0.0,
+            "max_lag_ms": round(stats["max_lag"] * 1000, 2),
+            "blocked_ms": round(stats["blocked_time"] * 1000, 2),
+        }
+
+    def close(self):
+        self.flush()
+        self._queue.put(_STOP)
+        self._thread.join()
+
+
+def _write_bytes(path, data):
+    with open(path, "wb") as fw:
+        fw.write(data)
+
+
+def _write_text(path, text):
+    with open(path, "w", encoding="utf-8") as fw:
+        fw.write(text)
@@ -0,0 +1,185 @@
+"""Offline micro-benchmarks for the observation pipeline.
+
+Everything runs on synthetic data, no browser or API key is needed.
+
+Usage:
+    python benchmark.py viewport --nodes 5000
+    python benchmark.py json --nodes 20000
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from utils_json import json_backend, json_dumps_bytes, json_loads
+from utils_webarena import IN_VIEWPORT_RATIO_THRESHOLD, get_elements_in_viewport_ratio, parse_accessibility_tree
+
+WINDOW_CONFIG = {
+    "win_top_bound": 0.0,
+    "win_left_bound": 0.0,
+    "win_width": 1920.0,
+    "win_height": 1068.0,
+    "win_right_bound": 1920.0,
+    "win_lower_bound": 1068.0,
+    "device_pixel_ratio": 1.0,
+}
+
+
+def make_synthetic_bounds(num_nodes, seed=0):
+    """Node bounds spread over a page five viewports tall, some of them empty."""
+    rng = random.Random(seed)
+    bounds = []
+    for _ in range(num_nodes):
+        if rng.random() < 0.1:
+            bounds.append(None)
+            continue
+        bounds.append([
+            rng.uniform(-200, 1900),
+            rng.uniform(-500, 5 * 1068),
+            rng.choice([0.0, rng.uniform(1, 600)]),
+            rng.uniform(1, 300),
+        ])
+    return bounds
+
+
+def make_synthetic_cdp_nodes(num_nodes, seed=0):
+    """A CDP `Accessibility.getFullAXTree` payload with `union_bound` already set."""
+    rng = random.Random(seed)
+    roles = ["generic", "StaticText", "link", "button", "listitem", "list", "heading", "img", "textbox"]
+    bounds = make_synthetic_bounds(num_nodes, seed)
+    nodes = [{
+        "nodeId": "1",
+        "ignored": False,
+        "role": {"type": "internalRole", "value": "RootWebArea"},
+        "name": {"type": "computedString", "value": "Synthetic page"},
+        "properties": [{"name": "focusable", "value": {"type": "booleanOrUndefined", "value": True}}],
+        "childIds": [],
+        "backendDOMNodeId": 1,
+        "frameId": "F" * 32,
+        "union_bound": [0.0, 0.0, 10.0, 10.0],
+    }]
+    for idx in range(1, num_nodes):
+        parent = nodes[rng.randrange(max(1, idx - 50), idx) if idx > 1 else 0]
+        node_id = str(idx + 1)
+        parent["childIds"].append(node_id)
+        role = rng.choice(roles)
+        node = {
+            "nodeId": node_id,
+            "ignored": False,
+            "role": {"type": "role", "value": role},
+            "name": {"type": "computedString", "value": "" if role == "generic" else f"{role} text {rng.randrange(1000)}"},
+            "properties": [{"name": "level", "value": {"type": "integer", "value": 2}}] if role == "heading" else [],
+            "childIds": [],
+            "parentId": parent["nodeId"],
+            "backendDOMNodeId": idx + 1,
+            "frameId": "F" * 32,
+            "union_bound": bounds[idx],
+        }
+        nodes.append(node)
+    return nodes
+
+
+def scalar_viewport_ratio(x, y, width, height, config):
+    overlap_width = max(0, min(x + width, config["win_width"]) - max(x, 0))
+    overlap_height = max(0, min(y + height, config["win_height"]) - max(y, 0))
+    return overlap_width * overlap_height / (width * height)
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_viewport(args):
+    bounds = make_synthetic_bounds(args.nodes)
+
+    def per_node_loop():
+        keep = []
+        for bound in bounds:
+            if not bound or bound[2] == 0 or bound[3] == 0:
+                keep.append(False)
+                continue
+            keep.append(scalar_viewport_ratio(*bound, WINDOW_CONFIG) >= IN_VIEWPORT_RATIO_THRESHOLD)
+        return keep
+
+    def gather():
+        return np.array(
+            [bound if bound else [np.nan] * 4 for bound in bounds], dtype=np.float64
+        ).reshape(-1, 4)
+
+    array = gather()
+
+    def vectorized():
+        return get_elements_in_viewport_ratio(array, WINDOW_CONFIG) >= IN_VIEWPORT_RATIO_THRESHOLD
+
+    loop_time, loop_keep = timed(per_node_loop, args.repeat)
+    gather_time, _ = timed(gather, args.repeat)
+    vec_time, vec_keep = timed(vectorized, args.repeat)
+    assert loop_keep == vec_keep.tolist(), "vectorized filter disagrees with the scalar reference"
+
+    print(f"nodes: {args.nodes}, kept: {int(vec_keep.sum())}")
+    print(f"per-node loop:     {loop_time * 1e3:.3f} ms total, {loop_time / args.nodes * 1e6:.3f} us/node")
+    print(f"gather bounds:     {gather_time * 1e3:.3f} ms total")
+    print(f"vectorized filter: {vec_time * 1e6:.1f} us total")
+
+
+def bench_json(args):
+    nodes = make_synthetic_cdp_nodes(args.nodes)
+    # one step: the AX tree payload comes in, obs_nodes_info and the transcript go out
+    ax_payload = json.dumps({"nodes": nodes})
+    _, obs_nodes_info = parse_accessibility_tree(nodes)
+    transcript = [
+        {"role": "user" if idx % 2 == 0 else "model", "parts": "Thought: " + "lorem ipsum " * 200}
+        for idx in range(30)
+    ]
+
+    def stdlib_step():
+        json.loads(ax_payload)
+        json.dumps(obs_nodes_info, indent=2)
+        json.dumps(transcript, indent=2)
+
+    def fast_step():
+        json_loads(ax_payload)
+        json_dumps_bytes(obs_nodes_info)
+        json_dumps_bytes(transcript)
+
+    def fast_pretty_step():
+        json_loads(ax_payload)
+        json_dumps_bytes(obs_nodes_info, pretty=True)
+        json_dumps_bytes(transcript, pretty=True)
+
+    stdlib_time, _ = timed(stdlib_step, args.repeat)
+    fast_time, _ = timed(fast_step, args.repeat)
+    pretty_time, _ = timed(fast_pretty_step, args.repeat)
+    print(f"nodes: {args.nodes}, backend: {json_backend()}")
+    print(f"stdlib json, indent=2:   {stdlib_time * 1e3:8.2f} ms/step")
+    print(f"{json_backend()}, compact:      {fast_time * 1e3:8.2f} ms/step (saves {(stdlib_time - fast_time) * 1e3:.2f} ms)")
+    print(f"{json_backend()}, pretty:       {pretty_time * 1e3:8.2f} ms/step (saves {(stdlib_time - pretty_time) * 1e3:.2f} ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    viewport = subparsers.add_parser("viewport", help="in-viewport ratio filter")
+    viewport.add_argument("--nodes", type=int, default=5000)
+    viewport.add_argument("--repeat", type=int, default=5)
+    viewport.set_defaults(func=bench_viewport)
+
+    json_parser = subparsers.add_parser("json", help="CDP decode and artifact dump per step, stdlib vs fast backend")
+    json_parser.add_argument("--nodes", type=int, default=20000)
+    json_parser.add_argument("--repeat", type=int, default=5)
+    json_parser.set_defaults(func=bench_json)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,8 @@ class Settings:
     
     OUTPUT_DIR: str = os.getenv("OUTPUT_DIR", "api_results")
     DOWNLOAD_DIR: str = os.getenv("DOWNLOAD_DIR", "downloads")
+    # 設定後截圖以去重後的 blob 存於此目錄，任務目錄只保留 manifest.json
+    ARTIFACT_STORE_DIR: str = os.getenv("ARTIFACT_STORE_DIR", "")
     
     MAX_CONCURRENT_TASKS: int = int(os.getenv("MAX_CONCURRENT_TASKS", "3"))
     TASK_TIMEOUT: int = int(os.getenv("TASK_TIMEOUT", "1800"))  # 30分鐘
@@ -0,0 +1,234 @@
+"""Token-budgeted conversation history of the main agent.
+
+Messages are kept in a deque together with an estimated token cost. Older
+observations are clipped incrementally as new ones arrive:
+- only the last `max_observations` observations keep their screenshots
+  (accessibility trees in text-only mode), older ones are reduced to the
+  text before "Observation:" plus a one-line placeholder
+- with a `token_budget`, the oldest observations are clipped until the
+  estimate fits, and if that is not enough the oldest user/model turns after
+  the first message (task, manual and guidelines) are dropped
+
+The budget only shapes the prompt (`messages`). Every message is also kept,
+as appended, in a transcript (`transcript`) that is saved at the end of the
+task, so evicted turns still show up in interact_messages.json.
+
+Every message is clipped at most once and dropped at most once, so a step
+costs O(1) amortized instead of rebuilding the whole list. Token counts are
+estimates (about 4 characters per text token, the encoder's estimate per
+image), good enough to budget the prompt and to log its size per step.
+
+Screenshots are not kept inline. `ImagePayloads.part` writes the encoded image
+to a per-run ArtifactStore (a temp directory, not the user-facing
+`--artifact_store_dir`) and returns an `image_ref` part (blob and mime type), and
+`ImagePayloads.materialize` turns the refs back into base64 `inline_data`
+right before a request, so the history only holds a few bytes per image.
+"""
+import base64
+import logging
+import threading
+from collections import OrderedDict, deque
+
+CHARS_PER_TOKEN = 4
+# Gemini's cost of an image that fits in one tile
+DEFAULT_IMAGE_TOKENS = 258
+
+
+def estimate_text_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_text(msg) -> str:
+    if isinstance(msg['parts'], str):
+        return msg['parts']
+    return "".join(part.get('text', '') for part in msg['parts'])
+
+
+def count_images(msg) -> int:
+    if isinstance(msg['parts'], str):
+        return 0
+    return sum(1 for part in msg['parts'] if 'inline_data' in part or 'image_ref' in part)
+
+
+class ImagePayloads:
+    """Encoded screenshots for the model, stored in an ArtifactStore and referenced from the messages"""
+
+    def __init__(self, store, cache_size: int = 8):
+        self.store = store
+        self.cache_size = cache_size
+        # recently materialized payloads, the main call and EGA send the same images
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def part(self, encoded: dict) -> dict:
+        """`image_ref` part for an `encode_screenshot` result"""
+        mime_type = encoded['mime_type']
+        entry = self.store.put_bytes(encoded['raw'], mime_type.split('/')[-1], mime_type)
+        return {'image_ref': {'blob': entry['blob'], 'mime_type': mime_type}}
+
+    def _data(self, blob: str) -> str:
+        with self._lock:
+            if blob in self._cache:
+                self._cache.move_to_end(blob)
+                return self._cache[blob]
+        data = base64.b64encode(self.store.get_bytes(blob)).decode('utf-8')
+        with self._lock:
+            self._cache[blob] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data
+
+    def materialize(self, messages: list) -> list:
+        """Copy of `messages` with the image refs replaced by inline data, for one request"""
+        materialized = []
+        for msg in messages:
+            if isinstance(msg['parts'], str) or not any('image_ref' in part for part in msg['parts']):
+                materialized.append(msg)
+                continue
+            parts = [{'inline_data': {'mime_type': part['image_ref']['mime_type'], 'data': self._data(part['image_ref']['blob'])}}
+                     if 'image_ref' in part else part for part in msg['parts']]
+            materialized.append({**msg, 'parts': parts})
+        return materialized
+
+
+class _Entry:
+    __slots__ = ("msg", "text_tokens", "img_tokens", "images")
+
+    def __init__(self, msg, img_tokens):
+        self.msg = msg
+        self.text_tokens = estimate_text_tokens(message_text(msg))
+        self.img_tokens = img_tokens
+        self.images = count_images(msg)
+
+    @property
+    def tokens(self):
+        return self.text_tokens + self.img_tokens
+
+
+class ConversationHistory:
+    def __init__(self, max_observations: int, token_budget: int = 0, text_only: bool = False):
+        """
+        Args:
+            max_observations: observations that keep their screenshot / accessibility tree
+            token_budget: estimated prompt tokens to stay under, 0 for no budget
+            text_only: observations are accessibility trees (string parts) instead of screenshots
+        """
+        self.max_observations = max_observations
+        self.token_budget = token_budget
+        self.text_only = text_only
+        self._head = None
+        self._tail = deque()
+        # every message as appended, for the saved transcript
+        self._transcript = []
+        # unclipped observations, oldest first
+        self._observations = deque()
+        # running totals of the kept messages
+        self.tokens = 0
+        self.images = 0
+        self.clipped = 0
+        self.dropped = 0
+
+    def _is_observation(self, msg) -> bool:
+        if msg['role'] != 'user':
+            return False
+        if self.text_only:
+            return isinstance(msg['parts'], str)
+        return count_images(msg) > 0
+
+    def append(self, msg, img_tokens: int = None):
+        """Add a message, `img_tokens` is the estimated cost of its images"""
+        if img_tokens is None:
+            img_tokens = count_images(msg) * DEFAULT_IMAGE_TOKENS
+        entry = _Entry(msg, img_tokens)
+        self._transcript.append(msg)
+        if self._head is None:
+            self._head = entry
+        else:
+            self._tail.append(entry)
+        self.tokens += entry.tokens
+        self.images += entry.images
+        if self._is_observation(msg):
+            self._observations.append(entry)
+        self._enforce()
+
+    def _last_entry(self):
+        return self._tail[-1] if self._tail else self._head
+
+    def replace_last(self, msg):
+        """Replace the last message (e.g. with the EGA explanation added), its image cost is kept"""
+        entry = self._last_entry()
+        self._transcript[-1] = msg
+        self.tokens -= entry.text_tokens
+        entry.msg = msg
+        entry.text_tokens = estimate_text_tokens(message_text(msg))
+        self.tokens += entry.text_tokens
+        self._enforce()
+
+    def refresh(self, msg):
+        """Re-estimate a message that was changed in place (a streamed reply that completed)"""
+        for entry in reversed(self._tail):
+            if entry.msg is msg:
+                self.tokens -= entry.text_tokens
+                entry.text_tokens = estimate_text_tokens(message_text(msg))
+                self.tokens += entry.text_tokens
+                break
+        self._enforce()
+
+    def _clip(self, entry):
+        text = message_text(entry.msg)
+        has_pdf = "You downloaded a PDF file" in text
+        if self.text_only:
+            omitted = "An accessibility tree and a PDF file." if has_pdf else "An accessibility tree."
+        else:
+            omitted = "A screenshot, a PDF file and some texts." if has_pdf else "A screenshot and some texts."
+        clipped_text = text.split("Observation:")[0].strip() + f"Observation: {omitted} (Omitted in context.)"
+        entry.msg = {'role': entry.msg['role'], 'parts': [{'text': clipped_text}]}
+        self.tokens -= entry.tokens
+        entry.text_tokens = estimate_text_tokens(clipped_text)
+        entry.img_tokens = 0
+        self.images -= entry.images
+        entry.images = 0
+        self.tokens += entry.tokens
+        self.clipped += 1
+
+    def _enforce(self):
+        while len(self._observations) > self.max_observations:
+            self._clip(self._observations.popleft())
+        if not self.token_budget:
+            return
+        # the latest observation is what the model has to act on, it is never clipped
+        while self.tokens > self.token_budget and len(self._observations) > 1:
+            self._clip(self._observations.popleft())
+        # then whole turns, oldest first, keeping the first message and everything from the latest observation on
+        latest = self._observations[-1] if self._observations else None
+        while self.tokens > self.token_budget and len(self._tail) > 2 and self._tail[0] is not latest:
+            self._drop(self._tail.popleft())
+            if self._tail and self._tail[0].msg['role'] != 'user' and self._tail[0] is not latest:
+                self._drop(self._tail.popleft())
+        if self.tokens > self.token_budget:
+            logging.warning(f"Conversation history ~{self.tokens} tokens, over the budget of {self.token_budget} with nothing left to evict")
+
+    def _drop(self, entry):
+        self.tokens -= entry.tokens
+        self.images -= entry.images
+        self.dropped += 1
+
+    def messages(self) -> list:
+        """The messages to send, oldest first"""
+        if self._head is None:
+            return []
+        return [self._head.msg] + [entry.msg for entry in self._tail]
+
+    def transcript(self) -> list:
+        """Every message of the conversation, unclipped and including the dropped ones"""
+        return list(self._transcript)
+
+    def stats(self) -> dict:
+        """Size of the prompt the history currently makes"""
+        return {
+            "messages": len(self._tail) + (self._head is not None),
+            "est_tokens": self.tokens,
+            "images": self.images,
+            "clipped": self.clipped,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,150 @@
+"""Per-call cost ledger built on the LLM telemetry records (see llm_client.py).
+
+Every record (label = call kind: main, EGA, manual, rag_summary, rag_embed,
+auto_eval, ...) is priced from a table of USD per 1M prompt / completion
+tokens. Models are matched by the longest table key they start with, so
+"gemini-2.5-pro-preview-03-25" uses the "gemini-2.5-pro" entry. Requests
+sent through a provider batch API get `BATCH_DISCOUNT`.
+
+The built-in table holds list prices at the time of writing. A JSON file with
+the same layout (`{"model": {"prompt": ..., "completion": ...}}`) overrides or
+extends it. Models that are in neither are priced at 0 and reported under
+`unpriced_models`.
+"""
+import logging
+from collections import defaultdict
+
+from utils_json import load_json_file
+
+# USD per 1M tokens
+DEFAULT_PRICES = {
+    "gemini-2.5-pro": {"prompt": 1.25, "completion": 10.0},
+    "gemini-2.5-flash": {"prompt": 0.30, "completion": 2.50},
+    "gemini-2.0-flash-lite": {"prompt": 0.075, "completion": 0.30},
+    "gemini-2.0-flash": {"prompt": 0.10, "completion": 0.40},
+    "gemini-1.5-pro": {"prompt": 1.25, "completion": 5.0},
+    "gemini-1.5-flash": {"prompt": 0.075, "completion": 0.30},
+    "text-embedding-004": {"prompt": 0.0, "completion": 0.0},
+    "gpt-4-vision-preview": {"prompt": 10.0, "completion": 30.0},
+    "gpt-4-turbo": {"prompt": 10.0, "completion": 30.0},
+    "gpt-4o-mini": {"prompt": 0.15, "completion": 0.60},
+    "gpt-4o": {"prompt": 2.50, "completion": 10.0},
+}
+BATCH_DISCOUNT = 0.5
+
+
+def load_prices(pricing_file: str = "") -> dict:
+    prices = dict(DEFAULT_PRICES)
+    if pricing_file:
+        prices.update(load_json_file(pricing_file))
+    return prices
+
+
+def _new_bucket():
+    return {"calls": 0, "errors": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            "latency_s": 0.0, "max_latency_s": 0.0, "cost_usd": 0.0}
+
+
+def _add_to_bucket(bucket, record):
+    bucket["calls"] += 1
+    bucket["errors"] += record.get("status") != "ok"
+    bucket["retries"] += max(0, record.get("attempts", 1) - 1)
+    bucket["prompt_tokens"] += record.get("prompt_tokens", 0)
+    bucket["completion_tokens"] += record.get("completion_tokens", 0)
+    latency = record.get("latency_s", 0.0)
+    bucket["latency_s"] += latency
+    bucket["max_latency_s"] = max(bucket["max_latency_s"], latency)
+    bucket["cost_usd"] += record.get("cost_usd", 0.0)
+
+
+def _round_buckets(buckets):
+    for bucket in buckets.values():
+        bucket["avg_latency_s"] = round(bucket["latency_s"] / bucket["calls"], 3) if bucket["calls"] else 0.0
+        bucket["latency_s"] = round(bucket["latency_s"], 3)
+        bucket["cost_usd"] = round(bucket["cost_usd"], 6)
+    return dict(buckets)
+
+
+class CostLedger:
+    def __init__(self, prices: dict = None):
+        self.prices = prices if prices is not None else dict(DEFAULT_PRICES)
+        # longest keys first, "gemini-2.0-flash-lite" before "gemini-2.0-flash"
+        self._keys = sorted(self.prices, key=len, reverse=True)
+        self._unpriced = set()
+        self._run = {"by_kind": defaultdict(_new_bucket), "by_model": defaultdict(_new_bucket), "task_costs": {}, "shared_cost": 0.0}
+
+    def _price_of(self, model):
+        for key in self._keys:
+            if model and model.startswith(key):
+                return self.prices[key]
+        if model not in self._unpriced:
+            self._unpriced.add(model)
+            logging.warning(f"No price for model {model}, its calls are counted at 0")
+        return None
+
+    def price(self, model: str, prompt_tokens: int, completion_tokens: int, batch: bool = False) -> float:
+        price = self._price_of(model)
+        if price is None:
+            return 0.0
+        cost = (prompt_tokens * price["prompt"] + completion_tokens * price["completion"]) / 1_000_000
+        return cost * BATCH_DISCOUNT if batch else cost
+
+    def price_records(self, records: list) -> list:
+        """Add `cost_usd` to each telemetry record, in place. Replayed responses are free."""
+        for record in records:
+            if record.get("cached"):
+                record["cost_usd"] = 0.0
+                continue
+            record["cost_usd"] = round(self.price(record.get("model"), record.get("prompt_tokens", 0),
+                                                  record.get("completion_tokens", 0), record.get("batch", False)), 8)
+        return records
+
+    def summarize(self, records: list, task_id=None, shared: bool = False) -> dict:
+        """Cost, tokens, latency and retries by call kind and by model.
+
+        With a task id the summary is added to the run rollup. `shared` calls
+        (e.g. a manual batch for all tasks) are added to the run totals only.
+        """
+        by_kind, by_model = defaultdict(_new_bucket), defaultdict(_new_bucket)
+        add_to_run = task_id is not None or shared
+        for record in records:
+            if "cost_usd" not in record:
+                self.price_records([record])
+            model = record.get("model") or "unknown"
+            _add_to_bucket(by_kind[record["label"]], record)
+            _add_to_bucket(by_model[model], record)
+            if add_to_run:
+                _add_to_bucket(self._run["by_kind"][record["label"]], record)
+                _add_to_bucket(self._run["by_model"][model], record)
+        total = sum(record["cost_usd"] for record in records)
+        if shared:
+            self._run["shared_cost"] += total
+        elif task_id is not None:
+            self._run["task_costs"][str(task_id)] = round(total, 6)
+        return {
+            "total_cost_usd": round(total, 6),
+            "calls": len(records),
+            "by_kind": _round_buckets(by_kind),
+            "by_model": _round_buckets(by_model),
+            "unpriced_models": sorted(model for model in self._unpriced if model),
+        }
+
+    def rollup(self) -> dict:
+        """Run-level totals of the tasks summarized so far"""
+        task_costs = self._run["task_costs"]
+        tasks = len(task_costs)
+        total = sum(task_costs.values()) + self._run["shared_cost"]
+        by_kind = _round_buckets({key: dict(bucket) for key, bucket in self._run["by_kind"].items()})
+        return {
+            "tasks": tasks,
+            "total_cost_usd": round(total, 6),
+            "shared_cost_usd": round(self._run["shared_cost"], 6),
+            # shared calls included, per task they are part of the cost as well
+            "avg_cost_per_task_usd": round(total / tasks, 6) if tasks else 0.0,
+            "max_cost_per_task_usd": max(task_costs.values(), default=0.0),
+            "calls_per_task": {kind: round(bucket["calls"] / tasks, 2) for kind, bucket in by_kind.items()} if tasks else {},
+            "by_kind": by_kind,
+            "by_model": _round_buckets({key: dict(bucket) for key, bucket in self._run["by_model"].items()}),
+            "task_costs": dict(task_costs),
+            "prices": self.prices,
+        }
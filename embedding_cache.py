@@ -0,0 +1,55 @@
+"""Persistent embedding cache keyed by (model, task type, sha256 of the text).
+
+Vectors are stored as float32 blobs in one SQLite table, so the cache is
+shared by every run and every task that ingests the same chunks (e.g. the
+same paper downloaded twice). WAL mode lets several `run.py` processes read
+and write it at the same time.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, task_type TEXT NOT NULL, "
+                           "text_hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, task_type, text_hash))")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get_many(self, model: str, task_type: str, texts: list) -> list:
+        """Cached vector per text, None for the texts that are not cached"""
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLite allows 999 parameters per statement in older builds
+            for i in range(0, len(hashes), 900):
+                batch = hashes[i:i + 900]
+                rows = self._conn.execute(f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND task_type = ? "
+                                          f"AND text_hash IN ({','.join('?' * len(batch))})", [model, task_type, *batch])
+                found.update(rows.fetchall())
+        return [np.frombuffer(found[h], dtype=np.float32).tolist() if h in found else None for h in hashes]
+
+    def put_many(self, model: str, task_type: str, texts: list, vectors: list):
+        rows = [(model, task_type, text_hash(text), np.asarray(vector, dtype=np.float32).tobytes())
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,97 @@
+"""Batched text embeddings for the RAG store.
+
+`GeminiEmbedder.embed` splits the texts into requests of `batch_size`
+(`embed_content` accepts up to 100 texts per request) and runs at most
+`max_workers` of them at a time, through an LLMClient so that retries,
+deadline, record/replay and telemetry apply. Documents are embedded with the
+RETRIEVAL_DOCUMENT task type, queries with RETRIEVAL_QUERY.
+
+With an EmbeddingCache (embedding_cache.py) only the texts that are not
+cached are sent, and the new vectors are added to the cache.
+
+Document throughput (chunks, requests, seconds, chunks/s) and the cache hit
+rate are kept until `pop_stats`, queries are not counted.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.genai import types
+
+MAX_BATCH_SIZE = 100
+
+
+class GeminiEmbedder:
+    def __init__(self, llm, model: str = "text-embedding-004", batch_size: int = MAX_BATCH_SIZE, max_workers: int = 4, cache=None):
+        """
+        Args:
+            llm: LLMClient around `embed_content`, see `gemini_embedding_client`
+            model: embedding model
+            batch_size: texts per request, at most MAX_BATCH_SIZE
+            max_workers: requests in flight at the same time
+            cache: EmbeddingCache consulted before any request, None disables it
+        """
+        self.llm = llm
+        self.model = model
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.max_workers = max(1, max_workers)
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._chunks = 0
+        self._requests = 0
+        self._seconds = 0.0
+        self._cache_hits = 0
+
+    def _embed_batch(self, texts, task_type):
+        response = self.llm.call("rag_embed", model=self.model, contents=texts,
+                                 config=types.EmbedContentConfig(task_type=task_type))
+        if len(response.embeddings) != len(texts):
+            raise ValueError(f"{self.model} returned {len(response.embeddings)} embeddings for {len(texts)} texts")
+        return [embedding.values for embedding in response.embeddings]
+
+    def embed(self, texts: list, task_type: str = "RETRIEVAL_DOCUMENT") -> list:
+        """One embedding per text, in order"""
+        if not texts:
+            return []
+        start = time.monotonic()
+        embeddings = self.cache.get_many(self.model, task_type, texts) if self.cache else [None] * len(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        # identical chunks are sent once
+        missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+        batches = [missing_texts[i:i + self.batch_size] for i in range(0, len(missing_texts), self.batch_size)]
+        if len(batches) == 1:
+            results = [self._embed_batch(batches[0], task_type)]
+        elif batches:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches)), thread_name_prefix="embed") as executor:
+                results = list(executor.map(lambda batch: self._embed_batch(batch, task_type), batches))
+        else:
+            results = []
+        new_embeddings = dict(zip(missing_texts, (embedding for batch in results for embedding in batch)))
+        if self.cache and new_embeddings:
+            self.cache.put_many(self.model, task_type, list(new_embeddings), list(new_embeddings.values()))
+        for i in missing:
+            embeddings[i] = new_embeddings[texts[i]]
+        if task_type == "RETRIEVAL_QUERY":
+            return embeddings
+        with self._lock:
+            self._chunks += len(texts)
+            self._cache_hits += len(texts) - len(missing)
+            self._requests += len(batches)
+            self._seconds += time.monotonic() - start
+        return embeddings
+
+    def embed_query(self, text: str) -> list:
+        return self.embed([text], task_type="RETRIEVAL_QUERY")[0]
+
+    def pop_stats(self) -> dict:
+        """Return the embedding throughput since the last call and reset it"""
+        with self._lock:
+            stats = {"chunks": self._chunks, "requests": self._requests, "seconds": round(self._seconds, 3),
+                     "chunks_per_s": round(self._chunks / self._seconds, 1) if self._seconds else 0.0,
+                     "cache_hits": self._cache_hits,
+                     "cache_hit_rate": round(self._cache_hits / self._chunks, 3) if self._chunks else 0.0}
+            self._reset_stats()
+        return stats
@@ -1,12 +1,19 @@
 import argparse
 import os
 import json
-import time
 import re
+import sys
 import base64
 
 from openai import OpenAI
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from artifact_store import list_task_artifacts
+from llm_client import LLMCallError, openai_llm_client
+from llm_batch import BATCH_BACKENDS, LocalBatch, OpenAIBatch, run_batch
+from utils_json import dump_json_file
+from cost_ledger import CostLedger, load_prices
+
 SYSTEM_PROMPT = """As an evaluator, you will be presented with three primary components to assist you in your role:
 
 1. Web Task Instruction: This is a clear and specific directive provided in natural language, detailing the online activity to be carried out. These requirements may include conducting searches, verifying information, comparing prices, checking availability, or any other action relevant to the specified web service (such as Amazon, Apple, ArXiv, BBC News, Booking etc).
@@ -33,8 +40,8 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode('utf-8')
 
 
-def auto_eval_by_gpt4v(process_dir, openai_client, api_model, img_num):
-    print(f'--------------------- {process_dir} ---------------------')
+def build_auto_eval_request(process_dir, api_model, img_num):
+    """Return (request, None), or (None, result) when the task has no answer to evaluate"""
     res_files = sorted(os.listdir(process_dir))
     with open(os.path.join(process_dir, 'interact_messages.json')) as fr:
         it_messages = json.load(fr)
@@ -42,7 +49,7 @@ def auto_eval_by_gpt4v(process_dir, openai_client, api_model, img_num):
     if len(it_messages) == 1:
         print('Not find answer for ' + process_dir + ' only system messages')
         print()
-        return 0
+        return None, 0
 
     task_info = it_messages[1]["content"]
     if type(task_info) == list:
@@ -56,7 +63,7 @@ def auto_eval_by_gpt4v(process_dir, openai_client, api_model, img_num):
     if 'Action: ANSWER' not in ans_info:
         print('Not find answer for ' + process_dir)
         print()
-        return 0
+        return None, 0
     pattern_ans = r"ANSWER[; ]+\[?(.[^\]]*)\]?"
     matches_ans = re.search(pattern_ans, ans_info)
     answer_content = matches_ans.group(1).strip()
@@ -66,15 +73,19 @@ def auto_eval_by_gpt4v(process_dir, openai_client, api_model, img_num):
     # b64_img = encode_image(os.path.join(process_dir, final_screenshot))
     whole_content_img = []
     pattern_png = r'screenshot(\d+)\.png'
-    matches = [(filename, int(re.search(pattern_png, filename).group(1))) for filename in res_files if re.search(pattern_png, filename)]
+    # (path, step, mime type), screenshots in the artifact store come from the task manifest
+    matches = [(os.path.join(process_dir, filename), int(re.search(pattern_png, filename).group(1)), 'image/png')
+               for filename in res_files if re.search(pattern_png, filename)]
+    matches += [(entry['path'], entry['step'], entry['mime_type'])
+                for entry in list_task_artifacts(process_dir) if entry.get('kind') == 'screenshot']
     matches.sort(key=lambda x: x[1])
     end_files = matches[-img_num:]
-    for png_file in end_files:
-        b64_img = encode_image(os.path.join(process_dir, png_file[0]))
+    for img_file, _, mime_type in end_files:
+        b64_img = encode_image(img_file)
         whole_content_img.append(
             {
                 'type': 'image_url',
-                'image_url': {"url": f"data:image/png;base64,{b64_img}"}
+                'image_url': {"url": f"data:{mime_type};base64,{b64_img}"}
             }
         )
 
@@ -92,29 +103,37 @@ def auto_eval_by_gpt4v(process_dir, openai_client, api_model, img_num):
             + [{'type': 'text', 'text': "Your verdict:\n"}]
         }
     ]
-    while True:
-        try:
-            print('Calling gpt4v API to get the auto evaluation......')
-            openai_response = openai_client.chat.completions.create(
-                model=api_model, messages=messages, max_tokens=1000, seed=42, temperature=0
-            )
-            print('Prompt Tokens:', openai_response.usage.prompt_tokens, ';',
-                  'Completion Tokens:', openai_response.usage.completion_tokens)
-            print('Cost:', openai_response.usage.prompt_tokens/1000 * 0.01
-                  + openai_response.usage.completion_tokens / 1000 * 0.03)
-
-            print('API call complete...')
-            break
-        except Exception as e:
-            print(e)
-            if type(e).__name__ == 'RateLimitError':
-                time.sleep(10)
-            elif type(e).__name__ == 'APIError':
-                time.sleep(15)
-            elif type(e).__name__ == 'InvalidRequestError':
-                exit(0)
-            else:
-                time.sleep(10)
+    return dict(model=api_model, messages=messages, max_tokens=1000, seed=42, temperature=0), None
+
+
+def parse_auto_eval_response(gpt_4v_res):
+    auto_eval_res = 0 if 'NOT SUCCESS' in gpt_4v_res else 1
+    if 'SUCCESS' not in gpt_4v_res:
+        auto_eval_res = None
+    return auto_eval_res
+
+
+def auto_eval_by_gpt4v(process_dir, llm, api_model, img_num, ledger=None):
+    print(f'--------------------- {process_dir} ---------------------')
+    request, auto_eval_res = build_auto_eval_request(process_dir, api_model, img_num)
+    if request is None:
+        return auto_eval_res
+    messages = request['messages']
+    try:
+        print('Calling gpt4v API to get the auto evaluation......')
+        # retries, backoff and deadline are handled by the client layer
+        openai_response = llm.call('auto_eval', **request)
+        print('Prompt Tokens:', openai_response.usage.prompt_tokens, ';',
+              'Completion Tokens:', openai_response.usage.completion_tokens)
+        ledger = ledger or CostLedger()
+        print('Cost:', ledger.price(openai_response.model, openai_response.usage.prompt_tokens,
+                                    openai_response.usage.completion_tokens))
+
+        print('API call complete...')
+    except LLMCallError as e:
+        print(e)
+        print()
+        return None
     gpt_4v_res = openai_response.choices[0].message.content
     print_message = messages[1]
     for idx in range(len(print_message['content'])):
@@ -125,14 +144,36 @@ def auto_eval_by_gpt4v(process_dir, openai_client, api_model, img_num):
     print(print_message)
     print(gpt_4v_res)
 
-    auto_eval_res = 0 if 'NOT SUCCESS' in gpt_4v_res else 1
-    if 'SUCCESS' not in gpt_4v_res:
-        auto_eval_res = None
+    auto_eval_res = parse_auto_eval_response(gpt_4v_res)
     print('Auto_eval_res:', auto_eval_res)
     print()
     return auto_eval_res
 
 
+def auto_eval_batch(task_dirs, llm, backend, api_model, img_num, poll_interval):
+    """Evaluate all task directories as one batch, returns {task dir name: verdict}"""
+    verdicts, requests = {}, {}
+    for file_dir in task_dirs:
+        task_name = os.path.basename(file_dir)
+        request, auto_eval_res = build_auto_eval_request(file_dir, api_model, img_num)
+        if request is None:
+            verdicts[task_name] = auto_eval_res
+        else:
+            requests[task_name] = ('auto_eval', request)
+    if backend == 'openai':
+        batch = OpenAIBatch(llm)
+    else:
+        batch = LocalBatch(llm)
+        poll_interval = min(poll_interval, 1.0)
+    for task_name, result in run_batch(batch, requests, poll_interval).items():
+        if result['error']:
+            print(f'{task_name}: {result["error"]}')
+            verdicts[task_name] = None
+        else:
+            verdicts[task_name] = parse_auto_eval_response(result['response'].choices[0].message.content)
+    return verdicts
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--process_dir', type=str, default='results')
@@ -140,22 +181,40 @@ def main():
     parser.add_argument("--api_key", default="key", type=str, help="YOUR_OPENAI_API_KEY")
     parser.add_argument("--api_model", default="gpt-4-vision-preview", type=str, help="api model name")
     parser.add_argument("--max_attached_imgs", type=int, default=1)
+    parser.add_argument("--batch", type=str, default="", choices=("",) + BATCH_BACKENDS,
+                        help="Submit all evaluations as one batch: openai (Batch API) or local (thread pool)")
+    parser.add_argument("--batch_poll_interval", type=float, default=60.0)
+    parser.add_argument("--pricing_file", type=str, default="", help="JSON of USD per 1M prompt/completion tokens per model")
     args = parser.parse_args()
+    ledger = CostLedger(load_prices(args.pricing_file))
 
-    client = OpenAI(api_key=args.api_key)
+    llm = openai_llm_client(OpenAI(api_key=args.api_key), deadline=300.0, max_retries=8)
     webs = ['Allrecipes', 'Amazon', 'Apple', 'ArXiv', 'BBC News', 'Booking', 'Cambridge Dictionary',
             'Coursera', 'ESPN', 'GitHub', 'Google Flights', 'Google Map', 'Google Search', 'Huggingface', 'Wolfram Alpha']
-
-    for web in webs:
-        web_task_res = []
-        for idx in range(0, 46):
-            file_dir = os.path.join(args.process_dir, 'task'+web+'--'+str(idx))
-            if os.path.exists(file_dir):
-                response = auto_eval_by_gpt4v(file_dir, client, args.api_model, args.max_attached_imgs)
+    task_dirs = {web: [os.path.join(args.process_dir, 'task'+web+'--'+str(idx)) for idx in range(0, 46)
+                       if os.path.exists(os.path.join(args.process_dir, 'task'+web+'--'+str(idx)))] for web in webs}
+
+    if args.batch:
+        verdicts = auto_eval_batch([file_dir for web in webs for file_dir in task_dirs[web]], llm, args.batch,
+                                   args.api_model, args.max_attached_imgs, args.batch_poll_interval)
+        dump_json_file(verdicts, os.path.join(args.process_dir, 'auto_eval_results.json'), pretty=True)
+        for web in webs:
+            web_task_res = [verdicts[os.path.basename(file_dir)] for file_dir in task_dirs[web]]
+            if web_task_res:
+                print(web_task_res)
+    else:
+        for web in webs:
+            web_task_res = []
+            for file_dir in task_dirs[web]:
+                response = auto_eval_by_gpt4v(file_dir, llm, args.api_model, args.max_attached_imgs, ledger)
                 web_task_res.append(response)
-            else:
-                pass
-        if web_task_res:
-            print(web_task_res)
+            if web_task_res:
+                print(web_task_res)
+
+    cost = ledger.summarize(ledger.price_records(llm.pop_telemetry()))
+    dump_json_file(cost, os.path.join(args.process_dir, 'auto_eval_cost.json'), pretty=True)
+    print('Total cost:', cost['total_cost_usd'])
+
+
 if __name__ == '__main__':
     main()
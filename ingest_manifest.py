@@ -0,0 +1,57 @@
+"""Manifest of the documents ingested into the RAG store.
+
+One entry per source (file name, as in the chunk metadata) with the sha256
+of the file, the chunking parameters and embedding model it was ingested
+with, and the ids of its chunks. `GeminiChromaRAG.add_pdf` skips a file whose
+entry is current. A changed file gets chunk ids derived from its new hash:
+the new chunks are written first, then the chunks of the old version are
+deleted, then the entry is updated. A run that stops halfway leaves the old
+entry in place, and the next ingestion completes the replacement.
+
+The manifest is rewritten through a temporary file and `os.replace`, after
+re-reading it, so concurrent runs only lose each other's entries when they
+ingest at the same moment.
+"""
+import hashlib
+import os
+import threading
+
+from utils_json import dump_json_file, load_json_file
+
+MANIFEST_NAME = "ingest_manifest.json"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fr:
+        for block in iter(lambda: fr.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        return load_json_file(self.path)
+
+    def get(self, source: str) -> dict | None:
+        with self._lock:
+            return self._load().get(source)
+
+    @staticmethod
+    def is_current(entry: dict | None, file_hash: str, params: dict) -> bool:
+        return entry is not None and entry["file_hash"] == file_hash and entry["params"] == params
+
+    def set(self, source: str, entry: dict):
+        with self._lock:
+            manifest = self._load()
+            manifest[source] = entry
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            dump_json_file(manifest, tmp_path, pretty=True)
+            os.replace(tmp_path, self.path)
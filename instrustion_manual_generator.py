@@ -5,6 +5,8 @@ from typing import Optional, List, Dict, Literal
 from json.decoder import JSONDecodeError
 import logging
 
+from llm_client import LLMClient, gemini_llm_client
+
 class InstructionManualGenerator:
     def __init__(
         self,
@@ -13,6 +15,7 @@ class InstructionManualGenerator:
         results: List[Dict],
         logger: logging.Logger,
         instruction_format: Literal["text_steps", "json_blocks"] = "text_steps",
+        llm: Optional[LLMClient] = None,
     ):
         """
         Initialize the instruction manual generator for WebVoyager tasks.
@@ -25,8 +28,9 @@ class InstructionManualGenerator:
             instruction_format (Literal["text_steps", "json_blocks"]): The desired output format for the manual.
                 - "text_steps": Generates a human-readable step-by-step manual.
                 - "json_blocks": Outputs a structured JSON manual with descriptions and sources.
+            llm (Optional[LLMClient]): Shared Gemini client layer. A new one is created from `api_key` if not given.
         """
-        self.client = genai.Client(api_key=api_key)
+        self.llm = llm or gemini_llm_client(genai.Client(api_key=api_key))
         self.task_goal = task_goal
         self.results = results
         self.instruction_format = instruction_format
@@ -168,6 +172,24 @@ Please output the results in the following JSON format:
 """
         return prompt
 
+    def _build_request(self, prompt: str) -> Dict:
+        """Keyword arguments of the Gemini request for `prompt`"""
+        return dict(
+            model="gemini-2.0-flash",
+            contents=[{"role": "user", "parts": [{"text": prompt}]}],
+            config=genai.types.GenerateContentConfig(
+                temperature=0.3,
+                max_output_tokens=10000,
+            )
+        )
+
+    def build_request(self) -> Dict:
+        """
+        Build the Gemini request of this manual without sending it, for batch submission
+        (see `llm_batch.py`). The response text goes to `parse_response`.
+        """
+        return self._build_request(self._generate_prompt())
+
     def _call_gemini(self, prompt: str) -> str:
         """
         Call Gemini API with the provided prompt and return the response.
@@ -179,14 +201,7 @@ Please output the results in the following JSON format:
             str: The response from Gemini API.
         """
         try:
-            response = self.client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=[{"role": "user", "parts": [{"text": prompt}]}],
-                config=genai.types.GenerateContentConfig(
-                    temperature=0.3,
-                    max_output_tokens=10000,
-                )
-            )
+            response = self.llm.call("manual", **self._build_request(prompt))
             return response.text
         except Exception as e:
             self.logger.error(f"Error calling Gemini API: {str(e)}")
@@ -213,7 +228,18 @@ Please output the results in the following JSON format:
         """
         prompt = self._generate_prompt()
         response_text = self._call_gemini(prompt)
+        return self.parse_response(response_text)
+
+    def parse_response(self, response_text: str) -> str:
+        """
+        Convert the model response into the manual string, according to `instruction_format`.
 
+        Args:
+            response_text (str): The text of the Gemini response.
+
+        Returns:
+            str: The instruction manual, "" when a "json_blocks" response cannot be parsed.
+        """
         if self.instruction_format == "json_blocks":
             try:
                 response_text = response_text.replace("```json", "").replace("```", "")
@@ -0,0 +1,152 @@
+"""Batch submission for independent offline LLM requests (instruction manuals,
+auto-eval verdicts).
+
+A batch is a dict of `key -> (label, request)`, where `request` holds the
+keyword arguments of `LLMClient.call`. Backends share one interface:
+`submit(requests) -> job id`, `poll(job id) -> progress` and
+`results(job id) -> {key: {"response": ..., "error": ...}}`.
+
+- `OpenAIBatch` goes through the OpenAI Batch API (JSONL upload, one
+  `/v1/chat/completions` line per request, `custom_id` = key)
+- `LocalBatch` is the stand-in for providers without a batch endpoint usable
+  here (the Gemini batch API of the installed google-genai needs Vertex AI):
+  the requests run on a thread pool through `LLMClient.call`, so they get its
+  retries, deadline, cache and telemetry
+
+`run_batch` submits, polls until the job is done, returns the results and
+closes the backend (`close()`, also on errors). Backends are context managers
+for use outside `run_batch`.
+"""
+import io
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils_json import json_dumps, json_loads
+
+BATCH_BACKENDS = ("local", "openai")
+BATCH_DONE_STATUS = ("completed", "failed", "expired", "cancelled")
+
+
+class _Backend:
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalBatch(_Backend):
+    def __init__(self, llm, max_workers: int = 8):
+        self.llm = llm
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-batch")
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _run(self, label, request):
+        try:
+            return {"response": self.llm.call(label, **request), "error": None}
+        except Exception as e:
+            return {"response": None, "error": f"{type(e).__name__}: {e}"}
+
+    def submit(self, requests: dict) -> str:
+        job_id = f"local-{next(self._ids)}"
+        futures = {key: self._executor.submit(self._run, label, request) for key, (label, request) in requests.items()}
+        with self._lock:
+            self._jobs[job_id] = futures
+        return job_id
+
+    def poll(self, job_id: str) -> dict:
+        futures = self._jobs[job_id]
+        completed = sum(future.done() for future in futures.values())
+        return {"status": "completed" if completed == len(futures) else "in_progress",
+                "completed": completed, "total": len(futures)}
+
+    def results(self, job_id: str) -> dict:
+        with self._lock:
+            futures = self._jobs.pop(job_id)
+        return {key: future.result() for key, future in futures.items()}
+
+    def close(self):
+        """Stop the worker threads, queued requests are cancelled (e.g. after a timeout)"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class OpenAIBatch(_Backend):
+    def __init__(self, llm, completion_window: str = "24h"):
+        """`llm` is an `openai_llm_client`, its SDK client does the uploads"""
+        self.llm = llm
+        self.client = llm.raw
+        self.completion_window = completion_window
+        self._labels = {}
+
+    def submit(self, requests: dict) -> str:
+        lines = [json_dumps({"custom_id": key, "method": "POST", "url": "/v1/chat/completions", "body": request})
+                 for key, (_, request) in requests.items()]
+        batch_file = self.client.files.create(file=("batch.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))), purpose="batch")
+        job = self.client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions",
+                                         completion_window=self.completion_window)
+        self._labels[job.id] = {key: label for key, (label, _) in requests.items()}
+        return job.id
+
+    def poll(self, job_id: str) -> dict:
+        job = self.client.batches.retrieve(job_id)
+        counts = job.request_counts
+        return {"status": job.status, "completed": (counts.completed + counts.failed) if counts else 0,
+                "total": counts.total if counts else 0}
+
+    def _read_lines(self, file_id):
+        if not file_id:
+            return []
+        content = self.client.files.content(file_id).read()
+        return [json_loads(line) for line in content.splitlines() if line.strip()]
+
+    def results(self, job_id: str) -> dict:
+        from openai.types.chat import ChatCompletion
+
+        job = self.client.batches.retrieve(job_id)
+        labels = self._labels.pop(job_id, {})
+        results = {key: {"response": None, "error": f"batch {job.status}"} for key in labels}
+        for line in self._read_lines(job.output_file_id) + self._read_lines(job.error_file_id):
+            key = line["custom_id"]
+            body = (line.get("response") or {}).get("body")
+            if line.get("error") or not body or (line["response"].get("status_code") or 200) >= 400:
+                results[key] = {"response": None, "error": json_dumps(line.get("error") or body)}
+                continue
+            response = ChatCompletion.model_validate(body)
+            usage = response.usage
+            # one telemetry record per request, as for the synchronous calls
+            self.llm.record({"label": labels.get(key, "batch"), "provider": self.llm.provider, "model": response.model,
+                             "attempts": 1, "status": "ok", "error": None, "batch": True,
+                             "prompt_tokens": usage.prompt_tokens if usage else 0,
+                             "completion_tokens": usage.completion_tokens if usage else 0})
+            results[key] = {"response": response, "error": None}
+        return results
+
+
+def run_batch(backend, requests: dict, poll_interval: float = 30.0, timeout: float = None) -> dict:
+    """Submit `requests`, wait for the job and return its results keyed like `requests`"""
+    if not requests:
+        return {}
+    start = time.monotonic()
+    with backend:
+        job_id = backend.submit(requests)
+        logging.info(f"Batch {job_id} submitted with {len(requests)} requests")
+        while True:
+            progress = backend.poll(job_id)
+            if progress["status"] in BATCH_DONE_STATUS:
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"batch {job_id} not done after {timeout:g}s ({progress})")
+            logging.info(f"Batch {job_id}: {progress['status']}, {progress['completed']}/{progress['total']}")
+            time.sleep(poll_interval)
+        results = backend.results(job_id)
+    errors = sum(result["error"] is not None for result in results.values())
+    logging.info(f"Batch {job_id} {progress['status']} in {time.monotonic() - start:.1f}s, {len(results) - errors} ok, {errors} errors")
+    return results
@@ -0,0 +1,153 @@
+"""Record/replay cache for LLM responses.
+
+Modes:
+- passthrough: no cache, every call goes to the provider
+- record: every call goes to the provider and its response is stored
+- replay: responses are served from the cache, a miss is an error and no
+  request is ever sent
+
+Entries are keyed by the sha256 of the normalized request (provider, model,
+system instruction, contents, generation config). Inline images and data URLs
+are replaced by their own sha256 before hashing, so keys stay small and
+entries never contain image data.
+
+Pages change between runs, so the screenshots of a rerun rarely hash to the
+recorded ones. Replay therefore falls back to the response that was recorded
+for the same call position: the n-th call with the same label (main, EGA, ...)
+within the same scope (task). Both kinds of hits are counted.
+
+Layout: `<dir>/responses/<key[:2]>/<key>.json`, `<dir>/sequence.jsonl` (call
+position -> key) and `<dir>/meta.json` (run metadata such as the recording
+date, which is part of the prompt).
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict
+
+from utils_json import dump_json_file, json_dumps, load_json_file, json_loads
+
+CACHE_MODES = ("passthrough", "record", "replay")
+
+
+def _normalize(value):
+    """JSON-compatible copy of a request with images replaced by their hash"""
+    if hasattr(value, "model_dump"):  # SDK request objects (pydantic)
+        value = value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, dict):
+        normalized = {}
+        for key, item in value.items():
+            if key == "data" and isinstance(item, (str, bytes)):
+                item = item.encode() if isinstance(item, str) else item
+                normalized[key] = "sha256:" + hashlib.sha256(item).hexdigest()
+            else:
+                normalized[key] = _normalize(item)
+        return normalized
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, bytes):
+        return "sha256:" + hashlib.sha256(value).hexdigest()
+    if isinstance(value, str) and value.startswith("data:") and ";base64," in value:
+        return "sha256:" + hashlib.sha256(value.encode()).hexdigest()
+    return value
+
+
+def request_key(provider: str, request: dict) -> str:
+    normalized = {"provider": provider, "request": _normalize(request)}
+    # sorted keys, the key must not depend on dict order
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str, mode: str = "record"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode}, expected one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._scope = ""
+        self._counters = defaultdict(int)
+        self._sequence = {}
+        self._reset_stats()
+        os.makedirs(os.path.join(path, "responses"), exist_ok=True)
+        self._sequence_path = os.path.join(path, "sequence.jsonl")
+        if os.path.exists(self._sequence_path):
+            with open(self._sequence_path, "rb") as fr:
+                for line in fr:
+                    if line.strip():
+                        entry = json_loads(line)
+                        self._sequence[entry["position"]] = entry["key"]
+        self._meta_path = os.path.join(path, "meta.json")
+        self.meta = load_json_file(self._meta_path) if os.path.exists(self._meta_path) else {}
+
+    def _reset_stats(self):
+        self._stats = {"hits": 0, "sequence_hits": 0, "misses": 0, "recorded": 0}
+
+    @property
+    def active(self) -> bool:
+        return self.mode != "passthrough"
+
+    def set_scope(self, scope: str):
+        """Start a new call sequence, e.g. one per task"""
+        with self._lock:
+            self._scope = scope
+            self._counters.clear()
+
+    def set_meta(self, key, value):
+        """Store run metadata (record mode only), existing values are kept"""
+        if self.mode != "record" or key in self.meta:
+            return
+        self.meta[key] = value
+        dump_json_file(self.meta, self._meta_path, pretty=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, "responses", key[:2], f"{key}.json")
+
+    def _next_position(self, label):
+        with self._lock:
+            position = f"{self._scope}:{label}:{self._counters[label]}"
+            self._counters[label] += 1
+        return position
+
+    def lookup(self, provider: str, label: str, request: dict):
+        """Return (key, position, stored entry or None)"""
+        key = request_key(provider, request)
+        position = self._next_position(label)
+        if self.mode != "replay":
+            return key, position, None
+        path = self._entry_path(key)
+        stat = "hits"
+        if not os.path.exists(path) and position in self._sequence:
+            path = self._entry_path(self._sequence[position])
+            stat = "sequence_hits"
+        if not os.path.exists(path):
+            stat = "misses"
+            entry = None
+        else:
+            entry = load_json_file(path)
+        with self._lock:
+            self._stats[stat] += 1
+        return key, position, entry
+
+    def store(self, key: str, position: str, entry: dict):
+        if self.mode != "record":
+            return
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        dump_json_file(entry, tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            with open(self._sequence_path, "a", encoding="utf-8") as fw:
+                fw.write(json_dumps({"position": position, "key": key}) + "\n")
+            self._sequence[position] = key
+            self._stats["recorded"] += 1
+
+    def pop_stats(self) -> dict:
+        """Return the cache statistics since the last call and reset them"""
+        with self._lock:
+            stats = dict(self._stats)
+            self._reset_stats()
+        stats["mode"] = self.mode
+        return stats
@@ -0,0 +1,266 @@
+"""Shared client layer for the LLM calls of the agent, EGA, manual generator,
+RAG summaries and the evaluator.
+
+`LLMClient.call` wraps one provider request with:
+- a deadline for the whole call, retries included
+- retries with jittered exponential backoff, for retryable status codes
+  (408/429/5xx) and transport errors only. Other errors fail at once.
+- a circuit breaker that fails fast after consecutive failures and lets a
+  probe through once the reset timeout has passed
+- optional hedging: a second identical request is sent when the first one
+  has not answered after `hedge_after` seconds, and the first answer wins
+- one telemetry record per call (label, model, attempts, latency, tokens,
+  outcome), logged as JSON and kept until `pop_telemetry`
+- an optional record/replay ResponseCache (see llm_cache.py)
+
+`gemini_llm_client` and `openai_llm_client` build an LLMClient around the
+respective SDK clients, `gemini_embedding_client` one for Gemini embeddings.
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils_json import json_dumps
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# transport-level failures, matched by name so that no SDK has to be imported here
+RETRYABLE_ERRORS = {"TimeoutError", "ConnectionError", "ConnectError", "ReadTimeout", "ConnectTimeout",
+                    "RemoteProtocolError", "ReadError", "APIConnectionError", "APITimeoutError"}
+
+
+class LLMCallError(Exception):
+    """An LLM call failed for good (non-retryable error, retries exhausted, deadline or open circuit)"""
+
+    def __init__(self, message, status=None, cause=None):
+        super().__init__(message)
+        self.status = status
+        self.cause = cause
+
+
+def error_status(error):
+    """HTTP status of an SDK error: `code` for google-genai, `status_code` for openai"""
+    for attr in ("code", "status_code"):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_retryable(error):
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+class CircuitBreaker:
+    """Closed -> open after `failure_threshold` consecutive failures, open ->
+    half-open after `reset_timeout` seconds (one probe call), half-open ->
+    closed on success or back to open on failure."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return self.state == "closed"
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    logging.warning(f"Circuit breaker open after {self._failures} consecutive failures")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+class LLMClient:
+    def __init__(self, send, usage, provider, deadline=120.0, max_retries=5, base_delay=1.0, max_delay=32.0,
+                 hedge_after=None, breaker=None, max_workers=8, raw=None, cache=None, dump=None, load=None, sink=None):
+        """
+        Args:
+            send: performs one request, `send(**request)` returns the provider response
+            usage: `usage(response)` returns (prompt_tokens, completion_tokens)
+            provider: name used in the telemetry
+            deadline: seconds for the whole call, retries included
+            max_retries: retries after the first attempt
+            base_delay, max_delay: backoff before retry n is uniform in [0, min(max_delay, base_delay * 2**n)]
+            hedge_after: seconds before a hedged duplicate request is sent, None disables hedging
+            breaker: CircuitBreaker, shared by every call of this client
+            raw: the SDK client, for the features that bypass `call` (streaming, context caching)
+            cache: ResponseCache in record or replay mode
+            dump, load: convert a provider response to JSON-compatible data and back, for the cache
+            sink: LLMClient that keeps the telemetry records of this one (e.g. embeddings next to the chat calls)
+        """
+        self._send = send
+        self._usage = usage
+        self.provider = provider
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.raw = raw
+        self.cache = cache if cache is not None and cache.active else None
+        self._dump = dump
+        self._load = load
+        self._sink = sink
+        # requests run here so that a deadline can abandon them
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{provider}-llm")
+        self._telemetry = []
+        self._lock = threading.Lock()
+
+    def _attempt(self, request, timeout):
+        """One attempt, hedged if configured. Returns (response, hedged, hedge_won)."""
+        start = time.monotonic()
+        primary = self._executor.submit(self._send, **request)
+        pending = {primary}
+        hedged = False
+        while True:
+            elapsed = time.monotonic() - start
+            wait_for = timeout - elapsed
+            if self.hedge_after and not hedged:
+                wait_for = min(wait_for, self.hedge_after - elapsed)
+            done, pending = wait(pending, timeout=max(0.0, wait_for), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result(), hedged, future is not primary
+                if not pending:
+                    raise future.exception()
+            elapsed = time.monotonic() - start
+            if elapsed >= timeout:
+                raise TimeoutError(f"no response within {timeout:.1f}s")
+            if self.hedge_after and not hedged and elapsed >= self.hedge_after:
+                pending.add(self._executor.submit(self._send, **request))
+                hedged = True
+
+    def call(self, label="llm", **request):
+        """Send `request` to the provider, raises LLMCallError when it cannot be completed"""
+        record = {"label": label, "provider": self.provider, "model": request.get("model"), "attempts": 0,
+                  "hedged": False, "hedge_won": False, "status": "ok", "error": None,
+                  "prompt_tokens": 0, "completion_tokens": 0}
+        start = time.monotonic()
+        try:
+            if self.cache:
+                key, position, entry = self.cache.lookup(self.provider, label, request)
+                if self.cache.mode == "replay":
+                    # never reaches the provider
+                    record["attempts"] = 0
+                    record["cached"] = True
+                    if entry is None:
+                        raise LLMCallError(f"{label}: no recorded response for {position} (replay mode)")
+                    response = self._load(entry["response"])
+                    record["prompt_tokens"], record["completion_tokens"] = self._usage(response)
+                    return response
+            for retry in range(self.max_retries + 1):
+                if not self.breaker.allow():
+                    raise LLMCallError(f"{self.provider} circuit breaker is open")
+                remaining = self.deadline - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise LLMCallError(f"{label}: deadline of {self.deadline:g}s exceeded")
+                record["attempts"] += 1
+                try:
+                    response, hedged, hedge_won = self._attempt(request, remaining)
+                except Exception as e:
+                    status = error_status(e)
+                    if not is_retryable(e):
+                        # a bad request says nothing about the health of the provider
+                        self.breaker.record_success()
+                        raise LLMCallError(f"{label}: {type(e).__name__}: {e}", status, e)
+                    self.breaker.record_failure()
+                    if retry == self.max_retries:
+                        raise LLMCallError(f"{label}: retries exhausted, last error {type(e).__name__}: {e}", status, e)
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+                    delay = min(delay, max(0.0, self.deadline - (time.monotonic() - start)))
+                    logging.warning(f"{label}: {type(e).__name__} (status {status}), retry {retry + 1}/{self.max_retries} in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                record["hedged"], record["hedge_won"] = hedged, hedge_won
+                record["prompt_tokens"], record["completion_tokens"] = self._usage(response)
+                if self.cache:
+                    self.cache.store(key, position, {"label": label, "provider": self.provider, "model": request.get("model"),
+                                                     "response": self._dump(response)})
+                return response
+        except LLMCallError as e:
+            record["status"] = "error"
+            record["error"] = str(e)
+            raise
+        finally:
+            record["latency_s"] = round(time.monotonic() - start, 3)
+            self.record(record)
+
+    def record(self, record: dict):
+        """Keep a telemetry record, also used for calls made outside `call` (e.g. streams)"""
+        if self._sink is not None:
+            self._sink.record(record)
+            return
+        logging.info(f"LLM call: {json_dumps(record)}")
+        with self._lock:
+            self._telemetry.append(record)
+
+    def pop_telemetry(self) -> list:
+        """Return the telemetry records since the last call and reset them"""
+        with self._lock:
+            telemetry, self._telemetry = self._telemetry, []
+        return telemetry
+
+
+def _gemini_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    return (getattr(usage, "prompt_token_count", 0) or 0), (getattr(usage, "candidates_token_count", 0) or 0)
+
+
+def _openai_usage(response):
+    usage = getattr(response, "usage", None)
+    return (getattr(usage, "prompt_tokens", 0) or 0), (getattr(usage, "completion_tokens", 0) or 0)
+
+
+def _pydantic_dump(response):
+    return response.model_dump(mode="json", exclude_none=True)
+
+
+def gemini_llm_client(genai_client, **kwargs) -> LLMClient:
+    """LLMClient for `genai_client.models.generate_content(model=..., contents=..., config=...)`"""
+    from google.genai import types
+
+    return LLMClient(lambda **request: genai_client.models.generate_content(**request), _gemini_usage, "gemini",
+                     raw=genai_client, dump=_pydantic_dump, load=types.GenerateContentResponse.model_validate, **kwargs)
+
+
+def _no_usage(response):
+    # embed_content reports no token counts outside Vertex AI
+    return 0, 0
+
+
+def gemini_embedding_client(genai_client, **kwargs) -> LLMClient:
+    """LLMClient for `genai_client.models.embed_content(model=..., contents=[...], config=...)`"""
+    from google.genai import types
+
+    return LLMClient(lambda **request: genai_client.models.embed_content(**request), _no_usage, "gemini",
+                     raw=genai_client, dump=_pydantic_dump, load=types.EmbedContentResponse.model_validate, **kwargs)
+
+
+def openai_llm_client(openai_client, **kwargs) -> LLMClient:
+    """LLMClient for `openai_client.chat.completions.create(model=..., messages=..., ...)`"""
+    from openai.types.chat import ChatCompletion
+
+    return LLMClient(lambda **request: openai_client.chat.completions.create(**request), _openai_usage, "openai",
+                     raw=openai_client, dump=_pydantic_dump, load=ChatCompletion.model_validate, **kwargs)
@@ -19,6 +19,7 @@ import io
 import mimetypes
 
 from config import settings, validate_settings
+from artifact_store import MANIFEST_NAME, list_task_artifacts
 
 validate_settings()
 
@@ -105,6 +106,13 @@ class TaskManager:
 
 task_manager = TaskManager()
 
+def iter_manifest_artifacts(output_dir: str):
+    """遍歷 output_dir 下各任務 manifest.json 登記的產物，返回 (任務目錄, 產物資訊)"""
+    for root, dirs, files in os.walk(output_dir):
+        if MANIFEST_NAME in files:
+            for entry in list_task_artifacts(root):
+                yield root, entry
+
 def validate_file_access(task_id: str, filename: str) -> tuple[bool, str]:
     """
     驗證文件訪問的安全性
@@ -145,6 +153,12 @@ def validate_file_access(task_id: str, filename: str) -> tuple[bool, str]:
                 else:
                     logger.warning(f"File path security check failed: {abs_file_path} not under {abs_output_dir}")
         
+        # 存於 artifact store 的截圖透過 manifest 解析（路徑已在 list_task_artifacts 中檢查）
+        for root, entry in iter_manifest_artifacts(output_dir):
+            if entry["name"] == safe_filename:
+                logger.info(f"Found file in artifact store: {entry['path']}")
+                return True, entry["path"]
+        
         logger.warning(f"File {safe_filename} not found in any subdirectory")
         return False, ""
         
@@ -161,6 +175,7 @@ def get_mime_type(filename: str) -> str:
     ext = filename.lower().split('.')[-1]
     mime_map = {
         'png': 'image/png',
+        'webp': 'image/webp',
         'jpg': 'image/jpeg', 
         'jpeg': 'image/jpeg',
         'pdf': 'application/pdf',
@@ -189,6 +204,9 @@ def create_zip_stream(task_id: str) -> io.BytesIO:
                     file_path = os.path.join(root, file)
                     arc_name = file
                     zip_file.write(file_path, arc_name)
+            
+            for root, entry in iter_manifest_artifacts(output_dir):
+                zip_file.write(entry["path"], entry["name"])
         
         zip_buffer.seek(0)
         return zip_buffer
@@ -311,7 +329,7 @@ async def list_task_files(task_id: str):
         for root, dirs, filenames in os.walk(output_dir):
             for filename in filenames:
                 # 跳過任務配置文件
-                if filename == 'task.json':
+                if filename in ('task.json', MANIFEST_NAME):
                     continue
                     
                 file_path = os.path.join(root, filename)
@@ -326,6 +344,16 @@ async def list_task_files(task_id: str):
                     "preview_url": f"/api/preview/{task_id}/{filename}"
                 })
         
+        for root, entry in iter_manifest_artifacts(output_dir):
+            files.append({
+                "name": entry["name"],
+                "path": os.path.relpath(os.path.join(root, entry["name"]), output_dir),
+                "size": entry["bytes"],
+                "mime_type": entry["mime_type"],
+                "download_url": f"/api/files/{task_id}/{entry['name']}",
+                "preview_url": f"/api/preview/{task_id}/{entry['name']}"
+            })
+        
         return {"files": files}
         
     except Exception as e:
@@ -509,6 +537,8 @@ async def execute_automation_task(task_id: str):
             cmd.append("--trajectory")
         if task["request"].EGA:
             cmd.append("--EGA")
+        if settings.ARTIFACT_STORE_DIR:
+            cmd.extend(["--artifact_store_dir", settings.ARTIFACT_STORE_DIR])
         
         # 啟動進程
         logger.info(f"Starting automation task {task_id} with command: {' '.join(cmd)}")
@@ -654,7 +684,7 @@ async def collect_task_results(task_id: str, output_dir: str) -> Dict:
             for root, dirs, files in os.walk(output_dir):
                 for file in files:
                     # 跳過任務配置文件
-                    if file == 'task.json':
+                    if file in ('task.json', MANIFEST_NAME):
                         continue
                         
                     file_path = os.path.join(root, file)
@@ -684,6 +714,19 @@ async def collect_task_results(task_id: str, output_dir: str) -> Dict:
                             results["iterations"] = max(results["iterations"], iter_num)
                         except:
                             pass
+            
+            # artifact store 中的截圖
+            for root, entry in iter_manifest_artifacts(output_dir):
+                results["files"].append({
+                    "name": entry["name"],
+                    "path": os.path.relpath(os.path.join(root, entry["name"]), output_dir),
+                    "size": entry["bytes"],
+                    "mime_type": entry["mime_type"],
+                    "download_url": f"/api/files/{task_id}/{entry['name']}",
+                    "preview_url": f"/api/preview/{task_id}/{entry['name']}"
+                })
+                if entry.get("kind") == "screenshot":
+                    results["iterations"] = max(results["iterations"], entry["step"])
         
         return results
         
@@ -0,0 +1,119 @@
+"""Cascaded model routing for the main-agent steps.
+
+Each step goes to the fast model unless the previous step asked for the strong
+one. Steps are escalated to the strong model:
+- within the step (`escalate_step`), when the fast reply is low-confidence
+  (`avg_logprobs` of the candidate below `min_avg_logprob`) or has no
+  Thought/Action, and when a speculative EGA call flags an error
+- for the next step, after an EGA-flagged error, a format error, or when the
+  same action is chosen twice in a row
+
+A step is counted once, for the model that gave its final reply. Per-model
+step counts and escalation reasons come from `pop_stats`. Latency,
+tokens and cost (once priced by cost_ledger.py) per model are summarized from
+the LLM telemetry records with `summarize_calls_by_model`.
+"""
+import threading
+from collections import Counter, defaultdict
+
+
+class ModelRouter:
+    def __init__(self, fast_model: str, strong_model: str, min_avg_logprob: float = -0.5):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.min_avg_logprob = min_avg_logprob
+        self._pending_reason = None
+        self._last_action = None
+        # model the current step was counted for
+        self._current = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._steps = Counter()
+        self._escalations = Counter()
+
+    def escalate(self, reason: str):
+        """Send the next step to the strong model"""
+        self._pending_reason = self._pending_reason or reason
+
+    def choose(self) -> str:
+        """Model for the current step, a pending escalation is used up"""
+        reason, self._pending_reason = self._pending_reason, None
+        with self._lock:
+            if reason:
+                self._escalations[reason] += 1
+            self._current = self.strong_model if reason else self.fast_model
+            self._steps[self._current] += 1
+        return self._current
+
+    def escalate_step(self, reason: str) -> str:
+        """Redo the current step with the strong model and return it, the step is not counted twice"""
+        with self._lock:
+            self._escalations[reason] += 1
+            if self._current != self.strong_model:
+                # the step moves from the model choose() picked to the strong one
+                if self._current is not None:
+                    self._steps[self._current] -= 1
+                self._steps[self.strong_model] += 1
+                self._current = self.strong_model
+        return self.strong_model
+
+    def check_reply(self, model: str, google_response) -> str | None:
+        """Reason to redo the step with the strong model, None when the fast reply is kept"""
+        if google_response is None or not google_response.candidates:
+            return None
+        candidate = google_response.candidates[0]
+        return self.check_text(model, candidate.content.parts[0].text or "", candidate.avg_logprobs)
+
+    def check_text(self, model: str, text: str, avg_logprobs: float | None = None) -> str | None:
+        """check_reply for a reply known only as text, e.g. assembled from a stream"""
+        if model == self.strong_model:
+            return None
+        if 'Thought:' not in text or 'Action:' not in text:
+            reason = "format_error"
+        elif avg_logprobs is not None and avg_logprobs < self.min_avg_logprob:
+            reason = "low_confidence"
+        else:
+            return None
+        self.escalate_step(reason)
+        return reason
+
+    def observe_action(self, action: str):
+        """Escalate the next step when the same action is chosen twice in a row"""
+        action = " ".join(action.split())
+        if action == self._last_action:
+            self.escalate("repeated_action")
+        self._last_action = action
+
+    def reset(self):
+        """Forget the state of the previous task"""
+        self._pending_reason = None
+        self._last_action = None
+        self._current = None
+
+    def pop_stats(self) -> dict:
+        """Return the routing statistics since the last call and reset them"""
+        with self._lock:
+            stats = {"steps": {model: steps for model, steps in self._steps.items() if steps}, "escalations": dict(self._escalations)}
+            self._reset_stats()
+        return stats
+
+
+def summarize_calls_by_model(calls: list, label: str = "main") -> dict:
+    """Calls, latency and tokens per model from LLM telemetry records"""
+    summary = defaultdict(lambda: {"calls": 0, "latency_s": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+    for call in calls:
+        if call["label"] != label:
+            continue
+        model = summary[call["model"]]
+        model["calls"] += 1
+        model["latency_s"] += call.get("latency_s", 0.0)
+        model["prompt_tokens"] += call.get("prompt_tokens", 0)
+        model["completion_tokens"] += call.get("completion_tokens", 0)
+        model["cost_usd"] += call.get("cost_usd", 0.0)
+    for model in summary.values():
+        model["avg_latency_s"] = round(model["latency_s"] / model["calls"], 3)
+        model["latency_s"] = round(model["latency_s"], 3)
+        model["cost_usd"] = round(model["cost_usd"], 6)
+    return dict(summary)
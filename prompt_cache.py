@@ -0,0 +1,110 @@
+"""Prompt-prefix cache for the main-agent Gemini calls of a task.
+
+The system instruction and the start of the first user message (task, manual
+and guidelines) are the same on every main-agent call of a task.
+`PromptPrefixCache.register` uploads them once as Gemini cached content, and
+later calls reference the cache and only send the rest of the conversation.
+
+When explicit caching is not available (unsupported model, prefix below the
+minimum cache size, other providers), the prefix is sent as its own leading
+message instead. It then stays byte-identical across calls, which keeps it
+eligible for the provider's implicit prefix caching. Cache-hit tokens are read
+from `cached_content_token_count` in either case.
+"""
+import logging
+import threading
+
+from google.genai import types
+
+
+class PromptPrefixCache:
+    def __init__(self, client, model: str, ttl_seconds: int = 3600):
+        self.client = client
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.system_instruction = None
+        self.prefix = None
+        self.cache_name = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    def register(self, system_instruction: str, prefix: str) -> bool:
+        """Register the stable prefix of a new task, returns True when it was cached by the provider"""
+        self.close()
+        self.system_instruction = system_instruction
+        self.prefix = prefix
+        try:
+            cache = self.client.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    contents=[{'role': 'user', 'parts': [{'text': prefix}]}],
+                    ttl=f"{self.ttl_seconds}s",
+                ),
+            )
+            self.cache_name = cache.name
+            cached_tokens = getattr(cache.usage_metadata, "total_token_count", None)
+            logging.info(f"Prompt prefix cached as {cache.name} ({cached_tokens} tokens)")
+        except Exception as e:
+            logging.info(f"Explicit prompt caching unavailable, sending the prefix as a leading message. {type(e).__name__}: {e}")
+        return self.cache_name is not None
+
+    def apply(self, messages, system_instruction, model=None):
+        """Return (contents, config kwargs) for a call.
+
+        Calls with another system instruction (e.g. EGA) or whose first message
+        does not start with the prefix are passed through unchanged. Calls to
+        another model than the cached one send the prefix as a leading message.
+        """
+        passthrough = messages, {"system_instruction": system_instruction}
+        if self.prefix is None or system_instruction != self.system_instruction or not messages:
+            return passthrough
+        first = messages[0]
+        text = first['parts'] if isinstance(first['parts'], str) else first['parts'][0]['text']
+        # clipped messages keep the prefix up to its trailing whitespace
+        stable = self.prefix.rstrip()
+        if first['role'] != 'user' or not text.startswith(stable):
+            return passthrough
+
+        rest = text[len(stable):].lstrip()
+        if isinstance(first['parts'], str):
+            first = {**first, 'parts': rest}
+        else:
+            first = {**first, 'parts': [{**first['parts'][0], 'text': rest}] + first['parts'][1:]}
+        if self.cache_name and (model is None or model == self.model):
+            return [first] + messages[1:], {"cached_content": self.cache_name}
+        prefix_msg = {'role': 'user', 'parts': [{'text': self.prefix}]}
+        return [prefix_msg, first] + messages[1:], {"system_instruction": system_instruction}
+
+    def record(self, usage_metadata):
+        prompt_tokens = getattr(usage_metadata, "prompt_token_count", 0) or 0
+        cached_tokens = getattr(usage_metadata, "cached_content_token_count", 0) or 0
+        # a speculative main call may still be in flight
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["prompt_tokens"] += prompt_tokens
+            self._stats["cached_tokens"] += cached_tokens
+        return cached_tokens
+
+    def pop_stats(self) -> dict:
+        """Return the cache statistics since the last call and reset them"""
+        with self._lock:
+            stats = dict(self._stats)
+            self._reset_stats()
+        stats["mode"] = "explicit" if self.cache_name else "local"
+        stats["hit_ratio"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0
+        return stats
+
+    def close(self):
+        """Delete the cached content of the current task"""
+        if self.cache_name:
+            try:
+                self.client.caches.delete(name=self.cache_name)
+            except Exception as e:
+                logging.warning(f"Failed to delete cached content {self.cache_name}: {e}")
+        self.cache_name = None
+        self.prefix = None
+        self.system_instruction = None
@@ -133,3 +133,24 @@ Key Guidelines You MUST follow:
 Your reply should strictly follow the format:
 Errors:{(Yes/No)Are there any errors?}
 Explanation:{If Yes, explain what are the errors and their possible causes, and suggest another action.}"""
+
+
+STRUCTURED_OUTPUT_PROMPT = """
+
+* Reply format (overrides the format above) *
+Reply with a JSON object instead of the Thought/Action lines:
+- "thought": your brief thoughts
+- "action": one of click, type, scroll, wait, goback, google, select, generatetext, answer
+- "element": the Numerical_Label for click, type, select and scroll (WINDOW to scroll the whole window)
+- "text": the content for type, up or down for scroll, the option for select, the prompt description for generatetext, the answer for answer"""
+
+
+ACTION_PLAN_PROMPT = """
+
+* Multi-action plans (overrides guideline 3 above) *
+When several actions can be done on the current page without looking at it again (e.g. filling the fields of a form and then clicking its submit button), you may give up to {max_actions} actions, one "Action:" line each, in the order to execute them:
+Thought: {{Your brief thoughts}}
+Action: Type [3]; [Paris]
+Action: Type [5]; [London]
+Action: Click [9]
+A plan may only hold Click, Type and Select actions on Numerical Labels of the current observation, any other action must be given alone. The plan stops as soon as the page changes, the next observation tells you which actions were executed."""
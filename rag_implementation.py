@@ -1,3 +1,4 @@
+import logging
 import os
 from typing import List, Dict
 import chromadb
@@ -8,14 +9,35 @@ from PyPDF2 import PdfReader
 import re
 from tqdm import tqdm
 
+from embedding_cache import EmbeddingCache
+from embeddings import GeminiEmbedder
+from ingest_manifest import IngestManifest, file_sha256
+from llm_client import LLMClient, gemini_embedding_client, gemini_llm_client
+
+
+class GeminiEmbeddingFunction(embedding_functions.EmbeddingFunction):
+    """ChromaDB 的嵌入函數，交給 GeminiEmbedder 批次處理"""
+
+    def __init__(self, embedder: GeminiEmbedder):
+        self.embedder = embedder
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return self.embedder.embed(list(input))
+
+
 class GeminiChromaRAG:
-    def __init__(self, api_key: str = None, persist_directory: str = "chroma_db"):
+    def __init__(self, api_key: str = None, persist_directory: str = "chroma_db", llm: LLMClient = None,
+                 embed_batch_size: int = 100, embed_workers: int = 4, embedding_cache_path: str = "embedding_cache.sqlite"):
         """
         初始化 RAG 系統
         
         Args:
             api_key: Google API 密鑰
             persist_directory: 向量存儲的持久化目錄
+            llm: 共用的 Gemini LLMClient（可錄製/重播），未提供時以 api_key 建立
+            embed_batch_size: 每個嵌入請求的文本塊數（最多 100）
+            embed_workers: 同時進行的嵌入請求數
+            embedding_cache_path: 嵌入快取的 SQLite 檔案，以 (模型, 文本 sha256) 為鍵，空字串停用
         """
         if api_key is None:
             api_key = os.getenv("GOOGLE_API_KEY")
@@ -24,59 +46,26 @@ class GeminiChromaRAG:
         
         # 使用新版 Google GenAI 客戶端
         self.client = genai.Client(api_key=api_key)
+        self.llm = llm or gemini_llm_client(self.client)
         self.embedding_model = "text-embedding-004"
         
-        # 自定義 Gemini 嵌入函數
-        class GeminiEmbeddingFunction(embedding_functions.EmbeddingFunction):
-            def __init__(self, client, model):
-                self.client = client
-                self.model = model
-            
-            def __call__(self, texts: List[str]) -> List[List[float]]:
-                embeddings = []
-                for text in texts:
-                    try:
-                        # 使用 generate_content 作為嵌入的替代方案
-                        # 因為新版 API 的嵌入方法可能有變化
-                        response = self.client.models.generate_content(
-                            model="gemini-2.0-flash",
-                            contents=[f"將以下文本轉換為數值表示（僅返回數字）：{text[:500]}"]  # 截斷文本避免太長
-                        )
-                        # 生成一個基於文本內容的簡單哈希向量
-                        import hashlib
-                        hash_val = hashlib.md5(text.encode()).hexdigest()
-                        # 將哈希值轉換為數值向量
-                        embedding = []
-                        for i in range(0, len(hash_val), 2):
-                            val = int(hash_val[i:i+2], 16) / 255.0  # 標準化到 0-1
-                            embedding.append(val)
-                        # 補充到指定維度
-                        while len(embedding) < 768:
-                            embedding.extend(embedding[:min(768-len(embedding), len(embedding))])
-                        embeddings.append(embedding[:768])  # 確保維度一致
-                        
-                    except Exception as e:
-                        print(f"嵌入生成失敗，使用文本哈希向量: {str(e)}")
-                        # 使用基於文本內容的確定性向量
-                        import hashlib
-                        hash_val = hashlib.md5(text.encode()).hexdigest()
-                        embedding = []
-                        for i in range(0, len(hash_val), 2):
-                            val = int(hash_val[i:i+2], 16) / 255.0
-                            embedding.append(val)
-                        while len(embedding) < 768:
-                            embedding.extend(embedding[:min(768-len(embedding), len(embedding))])
-                        embeddings.append(embedding[:768])
-                        
-                return embeddings
-        
+        # text-embedding-004 的批次嵌入，有併發上限，呼叫同樣經過重試、錄製/重播與 telemetry
+        self.embed_llm = gemini_embedding_client(self.client, cache=self.llm.cache, deadline=self.llm.deadline,
+                                                 max_retries=self.llm.max_retries, breaker=self.llm.breaker, sink=self.llm)
+        # 相同的文本塊（例如同一篇論文被下載多次）只嵌入一次，跨執行共用
+        self.embedding_cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+        self.embedder = GeminiEmbedder(self.embed_llm, self.embedding_model, embed_batch_size, embed_workers, self.embedding_cache)
+
+        # 已匯入文件的清單（檔案雜湊、切塊參數、chunk ids），未變更的檔案不再重新匯入
+        self.manifest = IngestManifest(persist_directory)
+
         # 初始化 ChromaDB 客戶端
         self.chroma_client = chromadb.PersistentClient(path=persist_directory)
         
-        # 創建集合
+        # 創建集合，集合名稱包含嵌入模型，不同模型的向量不會混在同一個集合
         self.collection = self.chroma_client.get_or_create_collection(
-            name="documents",
-            embedding_function=GeminiEmbeddingFunction(self.client, self.embedding_model)
+            name=f"documents_{self.embedding_model}",
+            embedding_function=GeminiEmbeddingFunction(self.embedder)
         )
     
     def _extract_text_from_pdf(self, pdf_path: str) -> List[Dict]:
@@ -167,15 +156,28 @@ class GeminiChromaRAG:
         
         return chunks
     
-    def add_pdf(self, pdf_path: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> None:
+    def add_pdf(self, pdf_path: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> bool:
         """
-        處理 PDF 文件並添加到向量存儲
+        處理 PDF 文件並添加到向量存儲，內容與切塊參數未變更時不做任何事
         
         Args:
             pdf_path: PDF 文件路徑
             chunk_size: 文本塊大小
             chunk_overlap: 文本塊重疊大小
+            
+        Returns:
+            是否有匯入（False 表示清單中已是最新版本）
         """
+        source = os.path.basename(pdf_path)
+        file_hash = file_sha256(pdf_path)
+        params = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "embedding_model": self.embedding_model}
+        entry = self.manifest.get(source)
+        # 清單是最新的，且向量存儲中確實有這些 chunks（chroma_db 可能被刪除過）
+        if self.manifest.is_current(entry, file_hash, params) and \
+                (not entry["ids"] or self.collection.get(ids=entry["ids"][:1], include=[])["ids"]):
+            logging.info(f"{source} unchanged since its last ingestion, skipped")
+            return False
+
         # 提取文本
         documents = self._extract_text_from_pdf(pdf_path)
         
@@ -196,13 +198,25 @@ class GeminiChromaRAG:
                     "chunk_id": i
                 })
         
-        # 添加到向量存儲
+        # 添加到向量存儲，ids 含檔案雜湊與切塊參數，新版本不會與舊版本衝突
+        ids = [f"{source}_{file_hash[:16]}_{chunk_size}_{chunk_overlap}_{i}" for i in range(len(all_chunks))]
         if all_chunks:
-            self.collection.add(
+            embeddings = self.embedder.embed(all_chunks)
+            logging.info(f"Embedded {source}: {self.embedder.pop_stats()}")
+            self.collection.upsert(
                 documents=all_chunks,
+                embeddings=embeddings,
                 metadatas=all_metadatas,
-                ids=[f"{doc['metadata']['source']}_{i}" for i in range(len(all_chunks))]
+                ids=ids
             )
+        # 新 chunks 寫入後才刪除舊版本，查詢不會看到空的文件
+        new_ids = set(ids)
+        stale_ids = [chunk_id for chunk_id in self.collection.get(where={"source": source}, include=[])["ids"] if chunk_id not in new_ids]
+        if stale_ids:
+            self.collection.delete(ids=stale_ids)
+        self.manifest.set(source, {"file_hash": file_hash, "params": params, "ids": ids})
+        logging.info(f"Ingested {source}: {len(ids)} chunks, {len(stale_ids)} old chunks removed")
+        return True
     
     def search(self, query: str, n_results: int = 5) -> Dict:
         """
@@ -216,7 +230,7 @@ class GeminiChromaRAG:
             包含文檔和相似度的結果字典
         """
         results = self.collection.query(
-            query_texts=[query],
+            query_embeddings=[self.embedder.embed_query(query)],
             n_results=n_results,
             include=["documents", "metadatas", "distances"]
         )
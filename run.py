@@ -6,22 +6,39 @@ import json
 import re
 import os
 import shutil
+import tempfile
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.action_chains import ActionChains
+from selenium.common.exceptions import StaleElementReferenceException
+from utils_webarena import get_bounding_client_rect, node_hit_at_point
 
-from prompts import SYSTEM_PROMPT, SYSTEM_PROMPT_TEXT_ONLY, SYSTEM_PREVIOUS_STEP, ERROR_GROUNDING_AGENT_PROMPT
+from prompts import SYSTEM_PROMPT, SYSTEM_PROMPT_TEXT_ONLY, SYSTEM_PREVIOUS_STEP, ERROR_GROUNDING_AGENT_PROMPT, STRUCTURED_OUTPUT_PROMPT, ACTION_PLAN_PROMPT
 from google import genai
 from google.genai import types
 from google.genai.chats import Chat
 from rag_implementation import GeminiChromaRAG
-from utils import get_web_element_rect, encode_image, extract_information, print_message,\
-    get_webarena_accessibility_tree, get_pdf_retrieval_ans_from_assistant, get_pdf_retrieval_ans_from_rag, clip_message_and_obs, clip_message_and_obs_text_only
+from utils import get_web_element_rect, capture_page_tiles, encode_screenshot, estimate_policy_tokens, IMAGE_POLICIES, extract_information, print_message,\
+    find_changed_region, crop_screenshot, screenshot_thumbnail, screenshots_unchanged, get_page_state_hash, get_webarena_accessibility_tree, get_pdf_retrieval_ans_from_assistant, get_pdf_retrieval_ans_from_rag
 
 from instrustion_manual_generator import InstructionManualGenerator
+from utils_json import install_fast_cdp_decoder
+from artifact_writer import ArtifactWriter
+from artifact_store import ArtifactStore, TaskManifest, IMAGE_FORMATS
+from prompt_cache import PromptPrefixCache
+from llm_client import LLMClient, LLMCallError, CircuitBreaker, gemini_llm_client
+from llm_cache import CACHE_MODES, ResponseCache
+from conversation_history import ConversationHistory, ImagePayloads
+from model_router import ModelRouter, summarize_calls_by_model
+from llm_batch import LocalBatch, run_batch
+from cost_ledger import CostLedger, load_prices
+from action_schema import ACTION_SCHEMA, apply_structured_reply
+from utils_json import dump_json_file
 
 
 def setup_logger(folder_path):
@@ -82,7 +99,7 @@ def driver_config(args):
     return options
 
 
-def format_msg(it, init_msg, pdf_obs, warn_obs, web_img_b64, web_text, prev_step_action=""):
+def format_msg(it, init_msg, pdf_obs, warn_obs, img_parts, web_text, prev_step_action=""):
     # 修改dict格式，從content改爲parts
     if it == 1:
         init_msg += f"{prev_step_action}\nI've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"
@@ -94,25 +111,24 @@ def format_msg(it, init_msg, pdf_obs, warn_obs, web_img_b64, web_text, prev_step
             ]
         }
         
-        init_msg_format['parts'].append({"inline_data": {"mime_type": "image/png", "data": f"{web_img_b64}"}})
+        init_msg_format['parts'].extend(img_parts)
         return init_msg_format
     else:
         if not pdf_obs:
             curr_msg = {
                 'role': 'user',
                 'parts': [
-                    {'text': f"{prev_step_action}\nObservation:{warn_obs} please analyze the attached screenshot and give the Thought and Action. I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"},
-                    {'inline_data': {"mime_type": "image/png", "data": "{}".format(web_img_b64)}}
+                    {'text': f"{prev_step_action}\nObservation:{warn_obs} please analyze the attached screenshot and give the Thought and Action. I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"}
                 ]
             }
         else:
             curr_msg = {
                 'role': 'user',
                 'parts': [
-                    {'text': f"{prev_step_action}\nObservation: {pdf_obs} Please analyze the response given by Assistant, then consider whether to continue iterating or not. The screenshot of the current page is also attached, give the Thought and Action. I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"},
-                    {'inline_data': {"mime_type": "image/png", "data": "{}".format(web_img_b64)}}
+                    {'text': f"{prev_step_action}\nObservation: {pdf_obs} Please analyze the response given by Assistant, then consider whether to continue iterating or not. The screenshot of the current page is also attached, give the Thought and Action. I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"}
                 ]
             }
+        curr_msg['parts'].extend(img_parts)
         return curr_msg
 
 
@@ -136,118 +152,192 @@ def format_msg_text_only(it, init_msg, pdf_obs, warn_obs, ac_tree, prev_step_act
             }
         return curr_msg
 
-def call_gemini_api(args, gemini_client: genai.Client, messages, system_instruction):
-    retry_times = 0
-    while True:
-        try:
-            if not args.text_only:
-                logging.info('Calling gemini API...')
-                google_response = gemini_client.models.generate_content(
-                    model=args.api_model,
-                    contents=messages,
-                    config=types.GenerateContentConfig(
-                        system_instruction=system_instruction,
-                        max_output_tokens=10000,
-                        temperature=args.temperature,
-                        seed=args.seed
-                    )
-                )
-            else:
-                logging.info('Calling gemini API...')
-                google_response = gemini_client.models.generate_content(
-                    model=args.api_model,
-                    contents=messages,
-                    config=types.GenerateContentConfig(
-                        system_instruction=system_instruction,
-                        max_output_tokens=10000,
-                        temperature=args.temperature,
-                        seed=args.seed
-                    )
-                )
-            if not google_response.candidates:
-                print("⚠️ Gemini 回傳為空！可能觸發了安全限制、格式錯誤，或 prompt 不清楚。")
-                for message in len(messages):
-                    print(message["parts"][0]["text"])
-                print(google_response)
-                # 可以儲存該 prompt 做進一步分析
-
-                
-            prompt_tokens = getattr(google_response.usage_metadata, "prompt_token_count", 0) or 0
-            completion_tokens = getattr(google_response.usage_metadata, "candidates_token_count", 0) or 0
-            
-            logging.info("Prompt Tokens: {}; Completion Tokens: {}".format(prompt_tokens, completion_tokens))
-            gemini_call_error = False
-            return prompt_tokens, completion_tokens, gemini_call_error, google_response
-        except Exception as e:
-            logging.info("Error occurred, retrying. Error type: {}".format(type(e).__name__))
-            
-            if type(e).__name__ == 'GoogleAPICallError' or type(e).__name__ == "RetryError":
-                logging.warning(f'Google API Error occurred, retrying... Error type: {type(e).__name__}')
-                time.sleep(10)  # 等待 10 秒後重試
-            elif type(e).__name__ == 'InvalidArgument':
-                logging.error(f'Invalid request to Gemini API: {str(e)}')
-                return None, None, True, None  # 返回錯誤狀態
-            else:
-                logging.error(f'Unexpected error: {type(e).__name__}: {str(e)}')
-                logging.info(messages[-1])
-                for idx, m in enumerate(messages):
-                    parts = m.get("parts")
-                    if not isinstance(parts, list):
-                        print(f"❌ Message[{idx}] has invalid parts type: {type(parts)}")
-                        print("Message content:", m)
-
-                return None, None, True, None  # 返回錯誤狀態
-        
-        retry_times += 1
-        if retry_times == 10:
-            logging.error('Retrying too many times')
-            return None, None, True, None
-                
+def call_gemini_api(args, llm: LLMClient, messages, system_instruction, prompt_cache=None, label="main", model=None):
+    # the cached prefix is referenced instead of being sent again
+    model = model or args.api_model
+    contents, prefix_config = prompt_cache.apply(messages, system_instruction, model) if prompt_cache else (messages, {"system_instruction": system_instruction})
+    # main-agent replies as JSON, see action_schema.py
+    schema_config = {"response_mime_type": "application/json", "response_schema": ACTION_SCHEMA} if args.structured_output and label == "main" else {}
+    try:
+        logging.info('Calling gemini API...')
+        google_response = llm.call(
+            label,
+            model=model,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                max_output_tokens=10000,
+                temperature=args.temperature,
+                seed=args.seed,
+                **prefix_config,
+                **schema_config
+            )
+        )
+    except LLMCallError as e:
+        logging.error(f'Gemini call failed: {e}')
+        logging.info(messages[-1])
+        return None, None, True, None  # 返回錯誤狀態
 
-def call_gpt4v_api(args, openai_client, messages):
-    retry_times = 0
-    while True:
-        try:
-            if not args.text_only:
-                logging.info('Calling gpt4v API...')
-                openai_response = openai_client.chat.completions.create(
-                    model=args.api_model, messages=messages, max_tokens=1000, seed=args.seed
-                )
-            else:
-                logging.info('Calling gpt4 API...')
-                openai_response = openai_client.chat.completions.create(
-                    model=args.api_model, messages=messages, max_tokens=1000, seed=args.seed, timeout=30
-                )
+    if not google_response.candidates:
+        print("⚠️ Gemini 回傳為空！可能觸發了安全限制、格式錯誤，或 prompt 不清楚。")
+        for message in messages:
+            parts = message["parts"]
+            print(parts if isinstance(parts, str) else parts[0].get("text", ""))
+        print(google_response)
+        return None, None, True, None
 
-            prompt_tokens = openai_response.usage.prompt_tokens
-            completion_tokens = openai_response.usage.completion_tokens
+    prompt_tokens = getattr(google_response.usage_metadata, "prompt_token_count", 0) or 0
+    completion_tokens = getattr(google_response.usage_metadata, "candidates_token_count", 0) or 0
 
-            logging.info(f'Prompt Tokens: {prompt_tokens}; Completion Tokens: {completion_tokens}')
+    logging.info("Prompt Tokens: {}; Completion Tokens: {}".format(prompt_tokens, completion_tokens))
+    if prompt_cache:
+        logging.info("Cached Prompt Tokens: {}".format(prompt_cache.record(google_response.usage_metadata)))
+    return prompt_tokens, completion_tokens, False, google_response
 
-            gpt_call_error = False
-            return prompt_tokens, completion_tokens, gpt_call_error, openai_response
 
-        except Exception as e:
-            logging.info(f'Error occurred, retrying. Error type: {type(e).__name__}')
+# a complete action line: "Action:" followed by some content and a line break
+ACTION_LINE_PATTERN = re.compile(r"Action:[ \t]*\S[^\n]*\n")
 
-            if type(e).__name__ == 'RateLimitError':
-                time.sleep(10)
 
-            elif type(e).__name__ == 'APIError':
-                time.sleep(15)
+def call_gemini_api_stream(args, llm: LLMClient, messages, system_instruction, executor, prompt_cache=None, label="main", model=None):
+    """Streaming variant of call_gemini_api that returns as soon as a complete
+    `Action:` line has arrived (or the stream ended).
 
-            elif type(e).__name__ == 'InvalidRequestError':
-                gpt_call_error = True
-                return None, None, gpt_call_error, None
+    Returns (text received so far, future). The rest of the stream is drained on
+    `executor`, and the future resolves to (prompt_tokens, completion_tokens,
+    gemini_call_error, full_text). When no action arrives within the client
+    deadline the stream is abandoned and the future reports an error, the
+    caller then falls back to the blocking call_gemini_api.
+    """
+    model = model or args.api_model
+    contents, prefix_config = prompt_cache.apply(messages, system_instruction, model) if prompt_cache else (messages, {"system_instruction": system_instruction})
+    action_ready = threading.Event()
+    state = {'text': '', 'abandoned': False}
+    failed = Future()
+    failed.set_result((None, None, True, ''))
+    if not llm.breaker.allow():
+        logging.error(f'Gemini call failed: {llm.provider} circuit breaker is open')
+        return '', failed
+
+    def consume():
+        usage_metadata = None
+        start = time.monotonic()
+        record = {"label": label, "provider": llm.provider, "model": model, "attempts": 1, "stream": True}
+        try:
+            logging.info('Calling gemini API (stream)...')
+            for chunk in llm.raw.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    max_output_tokens=10000,
+                    temperature=args.temperature,
+                    seed=args.seed,
+                    # a stalled connection ends the stream instead of blocking the drain forever
+                    http_options=types.HttpOptions(timeout=int(llm.deadline * 1000)),
+                    **prefix_config
+                )
+            ):
+                if state['abandoned'] or time.monotonic() - start > llm.deadline:
+                    raise TimeoutError(f"stream not finished within the deadline of {llm.deadline:g}s")
+                if chunk.usage_metadata:
+                    usage_metadata = chunk.usage_metadata
+                if chunk.text:
+                    state['text'] += chunk.text
+                    if not action_ready.is_set() and ACTION_LINE_PATTERN.search(state['text']):
+                        action_ready.set()
+        except Exception as e:
+            logging.error(f'Streaming error: {type(e).__name__}: {str(e)}')
+            llm.breaker.record_failure()
+            llm.record({**record, "status": "error", "error": f"{type(e).__name__}: {e}", "latency_s": round(time.monotonic() - start, 3)})
+            return None, None, True, state['text']
+        finally:
+            action_ready.set()
+        llm.breaker.record_success()
+        prompt_tokens = getattr(usage_metadata, "prompt_token_count", 0) or 0
+        completion_tokens = getattr(usage_metadata, "candidates_token_count", 0) or 0
+        llm.record({**record, "status": "ok", "error": None, "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens, "latency_s": round(time.monotonic() - start, 3)})
+        logging.info("Prompt Tokens: {}; Completion Tokens: {}".format(prompt_tokens, completion_tokens))
+        if prompt_cache and usage_metadata:
+            logging.info("Cached Prompt Tokens: {}".format(prompt_cache.record(usage_metadata)))
+        return prompt_tokens, completion_tokens, False, state['text']
+
+    future = executor.submit(consume)
+    if not action_ready.wait(timeout=llm.deadline):
+        state['abandoned'] = True
+        logging.error(f'Streaming error: no action within the deadline of {llm.deadline:g}s')
+        return '', failed
+    if not ACTION_LINE_PATTERN.search(state['text']):
+        # woken by the end of the stream, wait until its outcome is stored so the caller sees it
+        future.result()
+    return state['text'], future
+
+
+def drain_stream(pending_stream, accumulate_prompt_token, accumulate_completion_token):
+    """Wait for a streamed reply, store its full text in the model message and add its tokens"""
+    stream_future, model_msg = pending_stream
+    prompt_tokens, completion_tokens, gemini_call_error, full_text = stream_future.result()
+    if full_text:
+        model_msg['parts'][0]['text'] = full_text
+    if not gemini_call_error:
+        accumulate_prompt_token += prompt_tokens
+        accumulate_completion_token += completion_tokens
+        logging.info(f'Accumulate Prompt Tokens: {accumulate_prompt_token}; Accumulate Completion Tokens: {accumulate_completion_token}')
+    return prompt_tokens, completion_tokens, accumulate_prompt_token, accumulate_completion_token
+
+
+def timed_call(fn, *args):
+    """Run fn(*args) and return (result, latency in seconds)"""
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+def parse_EGA_response(EGA_res, pattern):
+    """Return (error_exist, EGA_explanation) from the Error Grounding Agent reply"""
+    verdict = re.split(pattern, EGA_res)[1].strip()
+    if verdict == 'Yes':
+        return True, re.split(pattern, EGA_res)[2].strip()
+    if verdict != 'No':
+        print("error_exist got unexpected result:", EGA_res)
+    return False, ""
+
+
+def add_EGA_explanation(msg, EGA_explanation, text_only):
+    """Copy of the user message with the EGA explanation appended"""
+    note = "\nAdditional Information: Looks like your previous thought has some problem in operation. Here is the message from Error Grounding Agent\n" + EGA_explanation
+    if text_only:
+        return {**msg, 'parts': msg['parts'] + note}
+    return {**msg, 'parts': [{**msg['parts'][0], 'text': msg['parts'][0]['text'] + note}] + msg['parts'][1:]}
+
+
+def generate_manuals_batch(args, llm, tasks, rag_system, result_dir, ledger):
+    """Instruction manuals of all tasks as one batch, keyed by task id and saved to manuals.json"""
+    generators, requests = {}, {}
+    for task in tasks:
+        rag_result = rag_system.search(task['ques'], n_results=3)
+        generator = InstructionManualGenerator(api_key=args.api_key, task_goal=task['ques'], results=rag_result,
+                                               logger=logging.getLogger(__name__), llm=llm)
+        generators[str(task['id'])] = (generator, rag_result)
+        requests[str(task['id'])] = ("manual", generator.build_request())
+    # the Gemini batch API of google-genai needs Vertex AI, the requests run on the local stand-in
+    results = run_batch(LocalBatch(llm, args.manual_batch_workers), requests, poll_interval=1.0)
+    manuals = {}
+    for task_id, (generator, rag_result) in generators.items():
+        result = results[task_id]
+        if result['error']:
+            logging.warning(f"Failed to generate instruction manual for task {task_id}: {result['error']}")
+            manuals[task_id] = str(rag_result)
+        else:
+            manuals[task_id] = generator.parse_response(result['response'].text)
+    dump_json_file(manuals, os.path.join(result_dir, 'manuals.json'), pretty=True)
+    llm_calls = ledger.price_records(llm.pop_telemetry())
+    dump_json_file(llm_calls, os.path.join(result_dir, 'manuals_llm_calls.json'), pretty=args.pretty_json)
+    logging.info(f"Manual batch cost: {ledger.summarize(llm_calls, shared=True)['total_cost_usd']} USD")
+    return manuals
 
-            else:
-                gpt_call_error = True
-                return None, None, gpt_call_error, None
 
-        retry_times += 1
-        if retry_times == 10:
-            logging.info('Retrying too many times')
-            return None, None, True, None
+# tiles of a full_page observation when no token budget is given
+FULL_PAGE_DEFAULT_TILES = 3
 
 
 def exec_action_click(info, web_ele, driver_task):
@@ -296,14 +386,16 @@ def exec_action_type(info, web_ele, driver_task):
     return warn_obs
 
 
-def exec_action_scroll(info, web_eles, driver_task, args, obs_info):
+def exec_action_scroll(info, web_eles, driver_task, args, obs_info, window_scroll=None):
     scroll_ele_number = info['number']
     scroll_content = info['parts']
     if scroll_ele_number == "WINDOW":
+        # full_page observations scroll past everything that was already captured
+        window_scroll = window_scroll or args.window_height*2//3
         if scroll_content == 'down':
-            driver_task.execute_script(f"window.scrollBy(0, {args.window_height*2//3});")
+            driver_task.execute_script(f"window.scrollBy(0, {window_scroll});")
         else:
-            driver_task.execute_script(f"window.scrollBy(0, {-args.window_height*2//3});")
+            driver_task.execute_script(f"window.scrollBy(0, {-window_scroll});")
     else:
         if not args.text_only:
             scroll_ele_number = int(scroll_ele_number)
@@ -370,13 +462,96 @@ def exec_action_select(info, web_ele, driver_task):
     time.sleep(3)
     return warn_obs
 
-def exec_action_generatetext(args, client, info, rag_system):
+
+# actions that may follow the first action of a plan, they act on elements of the same observation
+PLAN_ACTION_KEYS = ('click', 'type', 'select')
+# pixels an accessibility tree node may move before a planned action on it is dropped
+PLAN_BOUNDS_TOLERANCE = 2
+
+
+def parse_action_plan(gemini_res, max_actions):
+    """The Action lines of a reply, at most max_actions, the first one is the step's own action"""
+    return [action.strip() for action in re.findall(r"Action:[ \t]*(\S[^\n]*)", gemini_res)][:max_actions]
+
+
+def locate_planned_element(args, driver_task, number, web_eles, obs_info):
+    """
+    Element of a planned action, checked against the observation the plan was made on.
+    Returns (web element, None), or (None, reason) when the element is gone, moved or covered.
+    """
+    if not args.text_only:
+        web_ele = web_eles[int(number)]
+        # raises StaleElementReferenceException when the element was replaced by a previous action
+        on_top = driver_task.execute_script(
+            "var r = arguments[0].getBoundingClientRect();"
+            "var hit = document.elementFromPoint(r.left + r.width / 2, r.top + r.height / 2);"
+            "return !!hit && (hit === arguments[0] || arguments[0].contains(hit));", web_ele)
+        return (web_ele, None) if on_top else (None, 'element_covered')
+    # text only: the node is found again by its backend id, its bounds must not have moved
+    node = obs_info[number]
+    response = get_bounding_client_rect(driver_task, str(node['backend_id']))
+    if response.get("result", {}).get("subtype", "") == "error":
+        return None, 'stale_element'
+    value = response["result"]["value"]
+    current_box = [value["x"], value["y"], value["width"], value["height"]]
+    if any(abs(current - recorded) > PLAN_BOUNDS_TOLERANCE for current, recorded in zip(current_box, node['union_bound'])):
+        return None, 'element_moved'
+    center_x, center_y = current_box[0] + current_box[2] / 2, current_box[1] + current_box[3] / 2
+    if not node_hit_at_point(driver_task, str(node['backend_id']), center_x, center_y):
+        return None, 'element_covered'
+    web_ele = driver_task.execute_script("return document.elementFromPoint(arguments[0], arguments[1]);", center_x, center_y)
+    return web_ele, None
+
+
+def exec_action_plan(args, driver_task, actions, web_eles, obs_info, step_url):
+    """
+    Run the remaining actions of a plan without a new observation.
+    Stops before an action that is not a click/type/select, once the URL differs from step_url,
+    or when the target element is gone, has moved or is covered (e.g. by an overlay the previous
+    action opened). Call it only after a click/type/select first action.
+
+    Returns (executed actions, warn_obs, stop reason or None)
+    """
+    executed = []
+    warn_obs = ""
+    for action in actions:
+        if driver_task.current_url != step_url:
+            return executed, warn_obs, 'url_changed'
+        action_key, info = extract_information(action)
+        if action_key not in PLAN_ACTION_KEYS:
+            return executed, warn_obs, 'not_plannable'
+        number = info[0] if action_key == 'click' else info['number']
+        try:
+            web_ele, reason = locate_planned_element(args, driver_task, number, web_eles, obs_info)
+        except StaleElementReferenceException:
+            return executed, warn_obs, 'stale_element'
+        except (IndexError, KeyError, ValueError, AttributeError, TypeError):
+            return executed, warn_obs, 'bad_element'
+        if reason:
+            return executed, warn_obs, reason
+        try:
+            if action_key == 'click':
+                exec_action_click(info, web_ele, driver_task)
+            elif action_key == 'type':
+                warn_obs = exec_action_type(info, web_ele, driver_task)
+            else:
+                warn_obs = exec_action_select(info, web_ele, driver_task)
+        except StaleElementReferenceException:
+            return executed, warn_obs, 'stale_element'
+        except Exception as e:
+            logging.error(f'Planned action {action} failed: {e}')
+            return executed, warn_obs, 'error'
+        executed.append(action)
+    return executed, warn_obs, None
+
+
+def exec_action_generatetext(args, llm, info, rag_system):
     """
     使用 RAG 系統生成文本摘要
     
     參數：
     - args: 命令行參數物件，包含模型配置等信息
-    - client: Gemini API 客戶端
+    - llm: Gemini 的 LLMClient
     - info: 包含生成文本所需信息的字典，例如 {'parts': '任務描述文本'}
     - rag_system: RAG 系統實例，用於檢索和生成摘要
     
@@ -392,7 +567,7 @@ def exec_action_generatetext(args, client, info, rag_system):
         # 使用 RAG 系統生成摘要
         summary = get_pdf_retrieval_ans_from_rag(
             args=args,
-            client=client,
+            llm=llm,
             task=task_description,
             rag_system=rag_system
         )
@@ -411,15 +586,46 @@ def main():
     parser.add_argument('--trajectory', action='store_true')
     parser.add_argument('--rag', action='store_true')
     parser.add_argument("--EGA", action='store_true')
+    parser.add_argument("--speculative_EGA", action='store_true', help='Send the EGA and main calls concurrently, re-issue the main call only when EGA reports an error')
     parser.add_argument("--error_max_reflection_iter", type=int, default=1, help='Number of reflection restarts allowed when exceeding max_iter')
     parser.add_argument("--api_key", default="key", type=str, help="YOUR_OPENAI_API_KEY")
     parser.add_argument("--api_model", default="gemini-2.5-pro-preview-03-25", type=str, help="api model name")
+    parser.add_argument("--pricing_file", type=str, default="", help='JSON of USD per 1M prompt/completion tokens per model, overrides the built-in prices')
+    parser.add_argument("--manual_batch", action='store_true', help='Generate the instruction manuals of all tasks as one batch before the first task')
+    parser.add_argument("--manual_batch_workers", type=int, default=8, help='Concurrent requests of the manual batch')
+    parser.add_argument("--fast_model", default="", type=str, help="Model tried first on each step, escalated to api_model when needed. Empty to always use api_model")
+    parser.add_argument("--escalate_logprob", default=-0.5, type=float, help="Fast replies with a lower avg_logprobs are redone by api_model")
     parser.add_argument("--output_dir", type=str, default='results')
     parser.add_argument("--seed", type=int, default=None)
     parser.add_argument("--max_attached_imgs", type=int, default=1)
+    parser.add_argument("--history_token_budget", type=int, default=0, help='Estimated prompt tokens the conversation history is kept under, 0 for no budget')
+    parser.add_argument("--img_policy", type=str, default="png", choices=list(IMAGE_POLICIES), help='How screenshots are encoded for the model')
+    parser.add_argument("--img_max_side", type=int, default=None, help='Override the max image side of --img_policy, 0 keeps the original size')
+    parser.add_argument("--img_quality", type=int, default=None, help='Override the JPEG/WebP quality of --img_policy')
+    parser.add_argument("--img_grayscale", action='store_true', default=None, help='Send grayscale screenshots')
+    parser.add_argument("--obs_mode", type=str, default="full", choices=["full", "diff_crop", "full_page"], help='diff_crop: after the first step send a low-resolution frame plus a full-resolution crop of the changed region. full_page: send the page below the viewport as extra tiles')
+    parser.add_argument("--diff_frame_side", type=int, default=768, help='Max side of the low-resolution frame in diff_crop mode')
+    parser.add_argument("--full_page_token_budget", type=int, default=0, help=f'Image token budget for the tiles of one full_page observation, 0 sends {FULL_PAGE_DEFAULT_TILES} tiles of the chosen --img_policy')
     parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--llm_deadline", type=float, default=180.0, help='Seconds allowed for one LLM call, retries included')
+    parser.add_argument("--llm_max_retries", type=int, default=5, help='Retries on 408/429/5xx and transport errors, with jittered exponential backoff')
+    parser.add_argument("--llm_hedge_after", type=float, default=0, help='Send a duplicate request when the first has not answered after this many seconds, 0 disables')
+    parser.add_argument("--llm_breaker_threshold", type=int, default=5, help='Consecutive failures that open the circuit breaker')
+    parser.add_argument("--llm_breaker_reset", type=float, default=60.0, help='Seconds before an open circuit breaker lets a probe call through')
+    parser.add_argument("--llm_cache_mode", type=str, default="passthrough", choices=list(CACHE_MODES), help='record: store every LLM response, replay: serve them without network calls')
+    parser.add_argument("--llm_cache_dir", type=str, default="llm_cache", help='Directory of the recorded LLM responses')
+    parser.add_argument("--structured_output", action='store_true', help='Main-agent replies as JSON with a response schema, free-text replies still go through the regex parser')
+    parser.add_argument("--max_plan_actions", type=int, default=1, help='Actions the main agent may plan per step, the follow-up click/type/select actions run without a new observation while the page stays put')
+    parser.add_argument("--stream", action='store_true', help='Stream the main-agent reply and execute the action as soon as its line is complete')
+    parser.add_argument("--prompt_cache", action='store_true', help='Cache the system prompt and the task/manual prefix once per task with Gemini context caching')
+    parser.add_argument("--prompt_cache_ttl", type=int, default=3600, help='TTL in seconds of the cached prompt prefix')
+    parser.add_argument("--embed_batch_size", type=int, default=100, help='Chunks per text-embedding-004 request when ingesting PDFs (at most 100)')
+    parser.add_argument("--embed_workers", type=int, default=4, help='Embedding requests in flight at the same time')
+    parser.add_argument("--embedding_cache", type=str, default="embedding_cache.sqlite", help='SQLite cache of chunk embeddings keyed by model and text hash, empty disables')
     parser.add_argument("--download_dir", type=str, default="downloads")
     parser.add_argument("--text_only", action='store_true')
+    parser.add_argument("--skip_unchanged", action='store_true', help='Skip the EGA call when the previous action left the page unchanged')
+    parser.add_argument("--ac_tree_token_budget", type=int, default=0, help='Compress the accessibility tree to this many tokens, 0 disables')
     # for web browser
     parser.add_argument("--headless", action='store_true', help='The window of selenium')
     parser.add_argument("--save_accessibility_tree", action='store_true')
@@ -428,17 +634,42 @@ def main():
     parser.add_argument("--window_height", type=int, default=1068)  # for headless mode, there is no address bar
     parser.add_argument("--fix_box_color", action='store_true')
     parser.add_argument("--start_maximized", action='store_true')
+    parser.add_argument("--pretty_json", action='store_true', help='Indent the saved JSON artifacts')
+    parser.add_argument("--artifact_queue_size", type=int, default=64, help='Max pending artifacts for the background writer')
+    parser.add_argument("--artifact_store_dir", type=str, default=None, help='Store screenshots as deduplicated blobs in this directory, tasks keep a manifest.json')
+    parser.add_argument("--artifact_store_format", type=str, default="webp", choices=list(IMAGE_FORMATS), help='Lossless encoding of stored screenshots')
 
     args = parser.parse_args()
 
+    install_fast_cdp_decoder()
+
     # OpenAI client
     # client = OpenAI(api_key=args.api_key)
     client = genai.Client(api_key=args.api_key)
+    # every Gemini request goes through the shared client layer: deadlines, backoff, circuit breaker, telemetry
+    # record/replay of every response for deterministic reruns
+    llm_cache = ResponseCache(args.llm_cache_dir, args.llm_cache_mode) if args.llm_cache_mode != 'passthrough' else None
+    llm = gemini_llm_client(client, deadline=args.llm_deadline, max_retries=args.llm_max_retries, hedge_after=args.llm_hedge_after or None,
+                            breaker=CircuitBreaker(args.llm_breaker_threshold, args.llm_breaker_reset), cache=llm_cache)
+    # system prompt + task/manual prefix registered once per task, replay never talks to the provider
+    prompt_cache = PromptPrefixCache(client, args.api_model, args.prompt_cache_ttl) if args.prompt_cache and args.llm_cache_mode != 'replay' else None
+    # every LLM call of a task is priced, cost.json per task and cost_rollup.json for the run
+    ledger = CostLedger(load_prices(args.pricing_file))
+    main_system_prompt = SYSTEM_PROMPT if not args.text_only else SYSTEM_PROMPT_TEXT_ONLY
+    if args.structured_output:
+        main_system_prompt += STRUCTURED_OUTPUT_PROMPT
+    # the response schema has a single action, plans need the free-text reply
+    plan_actions_max = args.max_plan_actions if not args.structured_output else 1
+    if plan_actions_max > 1:
+        main_system_prompt += ACTION_PLAN_PROMPT.format(max_actions=plan_actions_max)
+    # fast model first, api_model when the step looks hard
+    router = ModelRouter(args.fast_model, args.api_model, args.escalate_logprob) if args.fast_model else None
     # 多輪對話模式
     # chat = client.chats.create(model=args.api_model, config=types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT, max_output_tokens=1000, seed=args.seed))
 
     # 初始化 RAG 系統
-    rag_system = GeminiChromaRAG(api_key=args.api_key)
+    rag_system = GeminiChromaRAG(api_key=args.api_key, llm=llm, embed_batch_size=args.embed_batch_size, embed_workers=args.embed_workers,
+                                 embedding_cache_path=args.embedding_cache)
     
     options = driver_config(args)
 
@@ -446,6 +677,16 @@ def main():
     current_time = time.strftime("%Y%m%d_%H_%M_%S", time.localtime())
     result_dir = os.path.join(args.output_dir, current_time)
     os.makedirs(result_dir, exist_ok=True)
+    # screenshots, trees and transcripts are written in the background
+    artifact_writer = ArtifactWriter(args.artifact_queue_size)
+    # EGA and speculative main calls
+    llm_executor = ThreadPoolExecutor(max_workers=2) if args.speculative_EGA or args.stream else None
+    # screenshots go to a content-addressed store shared across runs when enabled
+    artifact_store = ArtifactStore(args.artifact_store_dir, args.artifact_store_format) if args.artifact_store_dir else None
+    # the history only references the encoded screenshots, they are inlined per request.
+    # They are derived data, kept in a per-run temp store apart from the user-facing artifact store
+    payload_dir = tempfile.mkdtemp(prefix='image_payloads_')
+    image_payloads = ImagePayloads(ArtifactStore(payload_dir))
 
     # Load tasks
     tasks = []
@@ -454,6 +695,13 @@ def main():
             tasks.append(json.loads(line))
             
     rag_system.add_pdf('data/arXiv.pdf', chunk_size=1000, chunk_overlap=200) 
+    # the preloaded document is shared by all tasks, its embedding calls are billed to the run setup
+    setup_calls = ledger.price_records(llm.pop_telemetry())
+    dump_json_file(setup_calls, os.path.join(result_dir, 'setup_llm_calls.json'), pretty=args.pretty_json)
+    logging.info(f"Setup cost: {ledger.summarize(setup_calls, shared=True)['total_cost_usd']} USD")
+
+    # manuals only depend on the task and the preloaded documents
+    batch_manuals = generate_manuals_batch(args, llm, tasks, rag_system, result_dir, ledger) if args.manual_batch else {}
 
 
     for task_id in range(len(tasks)):
@@ -462,6 +710,11 @@ def main():
         os.makedirs(task_dir, exist_ok=True)
         setup_logger(task_dir)
         logging.info(f'########## TASK{task["id"]} ##########')
+        if llm_cache:
+            llm_cache.set_scope('task{}'.format(task["id"]))
+        if router:
+            router.reset()
+        task_manifest = TaskManifest(task_dir, artifact_store) if artifact_store else None
 
         driver_task = webdriver.Chrome(options=options)
         if args.start_maximized: driver_task.maximize_window()
@@ -505,38 +758,52 @@ def main():
         pattern = r'Thought:|Action:|Observation:|Errors:|Explanation:'
 
         # messages = [{'role': 'system', 'parts': SYSTEM_PROMPT}]
-        messages = []
+        # older observations are clipped as new ones arrive, see conversation_history.py
+        history = ConversationHistory(args.max_attached_imgs, args.history_token_budget, args.text_only)
+        prompt_sizes = []
+        # schema-parsed replies, regex fallbacks and Format ERROR round-trips
+        structured_stats = {'structured': 0, 'fallback': 0, 'format_error_retries': 0}
+        # multi-action plans: steps with a plan, follow-up actions run without observation, why plans stopped early
+        plan_stats = {'plans': 0, 'planned_actions': 0, 'executed_actions': 0, 'aborted': {}}
+        task_start = time.time()
         # message = {{'role': 'system', 'parts': SYSTEM_PROMPT}}
         obs_prompt = "Observation: please analyze the attached screenshot and give the Thought and Action. "
         if args.text_only:
-            messages = []
             # messages = [{'role': 'system', 'parts': SYSTEM_PROMPT_TEXT_ONLY}]
             # message = {'role': 'system', 'parts': SYSTEM_PROMPT}
             obs_prompt = "Observation: please analyze the accessibility tree and give the Thought and Action."
         
            
-        rag_result = rag_system.search(task['ques'], n_results=3)
+        if str(task['id']) in batch_manuals:
+            manual = batch_manuals[str(task['id'])]
+        else:
+            rag_result = rag_system.search(task['ques'], n_results=3)
         
-        # 使用 InstructionManualGenerator 處理 RAG 結果
-        manual_generator = InstructionManualGenerator(
-            api_key=args.api_key,
-            task_goal=task['ques'],
-            results=rag_result,
-            logger=logging.getLogger(__name__)
-        )
+            # 使用 InstructionManualGenerator 處理 RAG 結果
+            manual_generator = InstructionManualGenerator(
+                api_key=args.api_key,
+                task_goal=task['ques'],
+                results=rag_result,
+                logger=logging.getLogger(__name__),
+                llm=llm
+            )
         
-        try:
-            manual = manual_generator.generate_instruction_manual()
-            logging.info(f"Generated instruction manual:\n{manual}")
-        except Exception as e:
-            logging.warning(f"Failed to generate instruction manual: {e}")
-            # 如果生成失敗，回退到原始 RAG 結果
-            manual = str(rag_result)
-            logging.info(f"Using fallback RAG result:\n{manual}")
+            try:
+                manual = manual_generator.generate_instruction_manual()
+                logging.info(f"Generated instruction manual:\n{manual}")
+            except Exception as e:
+                logging.warning(f"Failed to generate instruction manual: {e}")
+                # 如果生成失敗，回退到原始 RAG 結果
+                manual = str(rag_result)
+                logging.info(f"Using fallback RAG result:\n{manual}")
 
         logging.info(f"manual:\n {manual}")
 
         today_date = datetime.date.today().strftime('%Y-%m-%d')
+        if llm_cache:
+            # the date is part of the prompt, replays reuse the recording date
+            llm_cache.set_meta('today', today_date)
+            today_date = llm_cache.meta.get('today', today_date)
         init_msg = f"""Today is {today_date}. Now given a task: {task['ques']}  Please interact with https://www.example.com and get the answer. \n"""
         init_msg = init_msg.replace('https://www.example.com', task['web'])
         init_msg += """Before taking action, carefully analyze the contents in [Manuals and QA pairs] below.
@@ -550,6 +817,8 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
  - If [Manuals and QA pairs] are entirely irrelevant or insufficient, proceed with the best available method while ensuring completeness.\n
 [Manuals and QA pairs]
 {manual}\n"""
+        if prompt_cache:
+            prompt_cache.register(main_system_prompt, init_msg)
         init_msg = init_msg + obs_prompt
 
         it = 0
@@ -565,6 +834,38 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
         
         # Reflection: Trajectory
         current_history = ""
+
+        # background accessibility tree dump that still uses the driver
+        tree_job = None
+
+        # streaming: (drain future, model message) of the reply still being received, time to first action per step
+        pending_stream = None
+        time_to_action = []
+
+        # speculative EGA: pending EGA call, main calls whose answers were dropped, hit/miss statistics
+        EGA_future = None
+        discarded_calls = []
+        speculative_hits = 0
+        speculative_misses = 0
+        speculative_saved = 0.0
+
+        # no-change detection: (url, DOM hash, screenshot thumbnail) of the previous observation
+        prev_page_state = None
+        unchanged_steps = 0
+
+        # diff_crop observations: unlabeled screenshot of the previous observation
+        diff_crop = args.obs_mode == 'diff_crop' and not args.text_only
+        prev_unlabeled_png = None
+        # full_page observations: tiles per observation within the token budget, page height covered by the last one
+        full_page = args.obs_mode == 'full_page' and not args.text_only
+        tile_tokens = estimate_policy_tokens(args.window_width, args.window_height, args.img_policy, args.img_max_side)
+        full_page_max_tiles = args.full_page_token_budget // tile_tokens if args.full_page_token_budget else FULL_PAGE_DEFAULT_TILES
+        if full_page and full_page_max_tiles < 2:
+            # the labels below the viewport would point at elements the model cannot see
+            logging.warning(f'full_page: a {args.img_policy} tile costs ~{tile_tokens} tokens, the budget of {args.full_page_token_budget} '
+                            f'fits only the viewport, falling back to viewport observations')
+            full_page = False
+        full_page_scroll = None
         
         
         print(f"Trajectory: {args.trajectory}")
@@ -573,19 +874,31 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
         
 
         while it < args.max_iter:
+            if pending_stream is not None:
+                _, _, accumulate_prompt_token, accumulate_completion_token = drain_stream(pending_stream, accumulate_prompt_token, accumulate_completion_token)
+                history.refresh(pending_stream[1])
+                pending_stream = None
             logging.info(f'Iter: {it}')
             it += 1
             if not fail_obs:
                 try:
+                    if args.skip_unchanged:
+                        # before the set-of-mark labels are added to the DOM
+                        page_url = driver_task.current_url
+                        page_dom_hash = get_page_state_hash(driver_task)
+                    # change detection compares screenshots without the labels, their colors are random per step
+                    unlabeled_png = driver_task.get_screenshot_as_png() if args.skip_unchanged or diff_crop else None
                     if not args.text_only:
                         # 獲取element區域
-                        rects, web_eles, web_eles_text = get_web_element_rect(driver_task, fix_color=args.fix_box_color)
+                        rects, web_eles, web_eles_text = get_web_element_rect(driver_task, fix_color=args.fix_box_color, full_page=full_page)
                         # print("rects:", rects)
                         # print("web_eles:", web_eles)
                         # print("web_eles_text:", web_eles_text)
                     else:
                         accessibility_tree_path = os.path.join(task_dir, 'accessibility_tree{}'.format(it))
-                        ac_tree, obs_info = get_webarena_accessibility_tree(driver_task, accessibility_tree_path)
+                        ac_tree, obs_info = get_webarena_accessibility_tree(driver_task, None, args.ac_tree_token_budget)
+                        artifact_writer.write_json(accessibility_tree_path + '.json', obs_info, args.pretty_json)
+                        artifact_writer.write_text(accessibility_tree_path + '.txt', ac_tree)
 
                 except Exception as e:
                     if not args.text_only:
@@ -595,14 +908,82 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                     logging.error(e)
                     break
 
-                img_path = os.path.join(task_dir, 'screenshot{}.png'.format(it))
-                driver_task.save_screenshot(img_path)
-
-                # encode image
-                b64_img = encode_image(img_path)
+                page_tiles = []
+                if full_page:
+                    page_tiles, page_height = capture_page_tiles(driver_task, full_page_max_tiles)
+                img_png = page_tiles[0][2] if page_tiles else driver_task.get_screenshot_as_png()
+                if task_manifest:
+                    artifact_writer.submit('screenshot{}'.format(it), task_manifest.add_screenshot, it, img_png)
+                else:
+                    artifact_writer.write_bytes(os.path.join(task_dir, 'screenshot{}.png'.format(it)), img_png)
+                for tile_idx, (_, _, tile_png) in enumerate(page_tiles[1:], start=1):
+                    if task_manifest:
+                        artifact_writer.submit('screenshot{}_tile{}'.format(it, tile_idx), task_manifest.add_screenshot, it, tile_png, '_tile{}'.format(tile_idx), 'screenshot_tile')
+                    else:
+                        artifact_writer.write_bytes(os.path.join(task_dir, 'screenshot{}_tile{}.png'.format(it, tile_idx)), tile_png)
+
+                page_unchanged = False
+                if args.skip_unchanged:
+                    page_state = (page_url, page_dom_hash, screenshot_thumbnail(unlabeled_png))
+                    page_unchanged = (prev_page_state is not None
+                                      and prev_page_state[:2] == page_state[:2]
+                                      and screenshots_unchanged(prev_page_state[2], page_state[2]))
+                    prev_page_state = page_state
+                    if page_unchanged:
+                        unchanged_steps += 1
+                        logging.info('Page unchanged after the previous action, skipping the EGA call')
+                        warn_obs += " The page is unchanged after your previous action (same URL, content and screenshot), so it had no visible effect. Do not repeat it, choose another element or action."
+                        error_exist = False
+                        EGA_explanation = ""
+
+                # encode image for the model, the saved screenshot stays full-resolution PNG
+                img_parts = []
+                img_note = ""
+                img_tokens = 0
+                changed_region = None
+                if diff_crop and prev_unlabeled_png is not None:
+                    # the changed region is found without the labels, the crop of the labeled screenshot keeps them
+                    changed_region = find_changed_region(prev_unlabeled_png, unlabeled_png)
+                prev_unlabeled_png = unlabeled_png
+                if changed_region:
+                    encoded_img = encode_screenshot(img_png, args.img_policy, args.diff_frame_side, args.img_quality, args.img_grayscale)
+                    encoded_crop = encode_screenshot(crop_screenshot(img_png, changed_region), args.img_policy, 0, args.img_quality, args.img_grayscale)
+                    img_parts = [image_payloads.part(encoded_img), image_payloads.part(encoded_crop)]
+                    img_tokens = encoded_img['tokens'] + encoded_crop['tokens']
+                    left, top, right, bottom = changed_region
+                    img_note = (f"\nThe first attached image is a low-resolution view of the whole page. The second is a full-resolution crop of the region "
+                                 f"that changed since your last action (x {left}-{right}, y {top}-{bottom} of the page). Read the numerical labels from the crop when they are in it.")
+                    logging.info(f"Changed region {changed_region}: frame {encoded_img['size']} + crop {encoded_crop['size']}, "
+                                 f"{encoded_img['original_bytes']} -> {encoded_img['bytes'] + encoded_crop['bytes']} bytes, "
+                                 f"~{encoded_img['tokens'] + encoded_crop['tokens']} image tokens")
+                elif len(page_tiles) > 1:
+                    encoded_tiles = [encode_screenshot(tile_png, args.img_policy, args.img_max_side, args.img_quality, args.img_grayscale) for _, _, tile_png in page_tiles]
+                    encoded_img = encoded_tiles[0]
+                    img_parts = [image_payloads.part(tile) for tile in encoded_tiles]
+                    img_tokens = sum(tile['tokens'] for tile in encoded_tiles)
+                    covered_top, covered_bottom = page_tiles[0][0], page_tiles[-1][0] + page_tiles[-1][1]
+                    full_page_scroll = covered_bottom - covered_top
+                    img_note = (f"\nThe {len(page_tiles)} attached images are consecutive slices of the page from top to bottom (y {covered_top}-{covered_bottom} of a {page_height}px page). "
+                                f"The numerical labels are valid across all of them, so you can read or operate on elements in any slice without scrolling.")
+                    logging.info(f"Full-page tiles: {len(page_tiles)} covering y {covered_top}-{covered_bottom} of {page_height}, "
+                                 f"{sum(tile['original_bytes'] for tile in encoded_tiles)} -> {sum(tile['bytes'] for tile in encoded_tiles)} bytes, "
+                                 f"~{sum(tile['tokens'] for tile in encoded_tiles)} image tokens")
+                else:
+                    full_page_scroll = None
+                    encoded_img = encode_screenshot(img_png, args.img_policy, args.img_max_side, args.img_quality, args.img_grayscale)
+                    img_parts = [image_payloads.part(encoded_img)]
+                    img_tokens = encoded_img['tokens']
+                    logging.info(f"Screenshot encoding ({args.img_policy}): {encoded_img['original_size']} -> {encoded_img['size']} {encoded_img['mime_type']}, "
+                                 f"{encoded_img['original_bytes']} -> {encoded_img['bytes']} bytes, ~{encoded_img['tokens']} image tokens")
+
+                # accessibility tree, dumped on the writer thread while the LLM calls are in flight.
+                # The driver must not be used again until tree_job is done.
+                if (not args.text_only) and args.save_accessibility_tree:
+                    accessibility_tree_path = os.path.join(task_dir, 'accessibility_tree{}'.format(it))
+                    tree_job = artifact_writer.submit(accessibility_tree_path, get_webarena_accessibility_tree, driver_task, accessibility_tree_path, args.ac_tree_token_budget, args.pretty_json)
                 
                 """=======================================Error Grounding Agent========================================================"""
-                if it > 1 and activate_EGA:
+                if it > 1 and activate_EGA and not page_unchanged:
                     # 將EGA的prompt和screenshot封裝進msg
                     # EGA_messages = [{'role': 'system', 'parts': ERROR_GROUNDING_AGENT_PROMPT}]
                     EGA_messages = []
@@ -611,49 +992,41 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                     EGA_user_message = {
                         'role': 'user',
                         'parts': [
-                            {'text': 'Thought:'+bot_thought+'\nAction:'+chosen_action+'\nScreenshot:'},
-                            {'inline_data': {"mime_type": "image/png", "data": "{}".format(b64_img)}}
-                        ]
+                            {'text': 'Thought:'+bot_thought+'\nAction:'+chosen_action+'\nScreenshot:'}
+                        ] + img_parts
                     }
                     EGA_message = EGA_user_message
                     EGA_messages.append(EGA_user_message)
-                    prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, client, EGA_messages, ERROR_GROUNDING_AGENT_PROMPT)
-                    if gemini_call_error:
-                        break
-                    else:
-                        accumulate_prompt_token += prompt_tokens
-                        accumulate_completion_token += completion_tokens
-                        logging.info(f'Accumulate Prompt Tokens: {accumulate_prompt_token}; Accumulate Completion Tokens: {accumulate_completion_token}')
-                        logging.info('API call complete...')
-                    EGA_res = google_response.candidates[0].content.parts[0].text
-                    if re.split(pattern, EGA_res)[1].strip() == 'Yes':
-                        error_exist = True
-                    elif re.split(pattern, EGA_res)[1].strip() == 'No':
+                    EGA_messages = image_payloads.materialize(EGA_messages)
+                    if args.speculative_EGA:
+                        # the main call is sent alongside, the EGA verdict decides whether its answer is kept
+                        EGA_future = llm_executor.submit(timed_call, call_gemini_api, args, llm, EGA_messages, ERROR_GROUNDING_AGENT_PROMPT, None, "EGA")
                         error_exist = False
                     else:
-                        error_exist = False
-                        print("error_exist got unexpected result:", EGA_res)
-                    if error_exist == True:
-                        EGA_explanation = re.split(pattern, EGA_res)[2].strip()
+                        prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, llm, EGA_messages, ERROR_GROUNDING_AGENT_PROMPT, None, "EGA")
+                        if gemini_call_error:
+                            break
+                        else:
+                            accumulate_prompt_token += prompt_tokens
+                            accumulate_completion_token += completion_tokens
+                            logging.info(f'Accumulate Prompt Tokens: {accumulate_prompt_token}; Accumulate Completion Tokens: {accumulate_completion_token}')
+                            logging.info('API call complete...')
+                        error_exist, EGA_explanation = parse_EGA_response(google_response.candidates[0].content.parts[0].text, pattern)
+                        if router and error_exist:
+                            router.escalate('EGA_error')
                 
                 """==================================================================================================================="""
-                    
-                # accessibility tree
-                if (not args.text_only) and args.save_accessibility_tree:
-                    accessibility_tree_path = os.path.join(task_dir, 'accessibility_tree{}'.format(it))
-                    get_webarena_accessibility_tree(driver_task, accessibility_tree_path)
 
                 # format msg
                 if not args.text_only:
-                    curr_msg = format_msg(it, init_msg, pdf_obs, warn_obs, b64_img, web_eles_text, SYSTEM_PREVIOUS_STEP + current_history)
-                    if error_exist == True:
-                        curr_msg['parts'][0]['text'] += ("\nAdditional Information: Looks like your previous thought has some problem in operation. Here is the message from Error Grounding Agent\n"+EGA_explanation)
+                    curr_msg = format_msg(it, init_msg, pdf_obs, warn_obs, img_parts, web_eles_text, SYSTEM_PREVIOUS_STEP + current_history)
+                    curr_msg['parts'][0]['text'] += img_note
                 else:
                     curr_msg = format_msg_text_only(it, init_msg, pdf_obs, warn_obs, ac_tree, SYSTEM_PREVIOUS_STEP + current_history)
-                    if error_exist == True:
-                        curr_msg['parts']+=("\nAdditional Information: Looks like your previous thought has some problem in operation. Here is the message from Error Grounding Agent\n"+EGA_explanation)
+                if error_exist == True:
+                    curr_msg = add_EGA_explanation(curr_msg, EGA_explanation, args.text_only)
                 message = curr_msg
-                messages.append(curr_msg)
+                history.append(curr_msg, img_tokens)
             else:
                 curr_msg = {
                     'role': 'user',
@@ -662,23 +1035,85 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                     ]
                 }
                 message = curr_msg
-                messages.append(curr_msg)
-                
+                history.append(curr_msg)
 
-            # Clip messages, too many attached images may cause confusion
-            if not args.text_only:
-                messages = clip_message_and_obs(messages, args.max_attached_imgs)
-                # EGA_messages = clip_message_and_obs(EGA_messages, args.max_attached_imgs)
-            else:
-                messages = clip_message_and_obs_text_only(messages, args.max_attached_imgs)
-                # EGA_messages = clip_message_and_obs_text_only(EGA_messages, args.max_attached_imgs)
+            # too many attached images may cause confusion, the history keeps the last max_attached_imgs observations
+            messages = history.messages()
+            request_messages = image_payloads.materialize(messages)
+            prompt_size = history.stats()
+            prompt_sizes.append(prompt_size['est_tokens'])
+            logging.info(f'Prompt size: {prompt_size}')
 
             # Call GPT-4v API
-            # prompt_tokens, completion_tokens, gpt_call_error, openai_response = call_gpt4v_api(args, client, messages)
-            if not args.text_only:
-                prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, client, messages, SYSTEM_PROMPT)
+            call_start = time.time()
+            system_instruction = main_system_prompt
+            stream_future = None
+            escalation = None
+            step_model = router.choose() if router else args.api_model
+            if EGA_future is not None:
+                main_future = llm_executor.submit(timed_call, call_gemini_api, args, llm, request_messages, system_instruction, prompt_cache, "main", step_model)
+                (prompt_tokens, completion_tokens, gemini_call_error, google_response), EGA_latency = EGA_future.result()
+                EGA_future = None
+                if gemini_call_error:
+                    discarded_calls.append(main_future)
+                    break
+                accumulate_prompt_token += prompt_tokens
+                accumulate_completion_token += completion_tokens
+                error_exist, EGA_explanation = parse_EGA_response(google_response.candidates[0].content.parts[0].text, pattern)
+                if error_exist:
+                    # miss: the speculative answer did not see the EGA explanation, ask again with it
+                    speculative_misses += 1
+                    discarded_calls.append(main_future)
+                    logging.info(f'Speculative main call discarded, EGA reported an error ({EGA_latency:.2f}s)')
+                    history.replace_last(add_EGA_explanation(messages[-1], EGA_explanation, args.text_only))
+                    messages = history.messages()
+                    request_messages = image_payloads.materialize(messages)
+                    if router:
+                        # same step, redone with the strong model
+                        step_model = router.escalate_step('EGA_error')
+                    prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, llm, request_messages, system_instruction, prompt_cache, "main", step_model)
+                else:
+                    (prompt_tokens, completion_tokens, gemini_call_error, google_response), main_latency = main_future.result()
+                    speculative_hits += 1
+                    # sequential calls would have taken EGA_latency + main_latency
+                    speculative_saved += min(EGA_latency, main_latency)
+                    logging.info(f'Speculative main call kept, saved {min(EGA_latency, main_latency):.2f}s')
+            elif args.stream and not llm.cache and not args.structured_output and plan_actions_max <= 1:
+                gemini_res, stream_future = call_gemini_api_stream(args, llm, request_messages, system_instruction, llm_executor, prompt_cache, "main", step_model)
+                if stream_future.done() and stream_future.result()[2]:
+                    # the stream failed or stalled before an action arrived, fall back to the blocking call (deadline, retries, breaker)
+                    stream_future = None
+                    prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, llm, request_messages, system_instruction, prompt_cache, "main", step_model)
+                else:
+                    # token usage is counted once the stream is drained
+                    prompt_tokens, completion_tokens, gemini_call_error, google_response = 0, 0, False, None
+                    escalation = router.check_text(step_model, gemini_res) if router else None
+                    if escalation:
+                        # the streamed reply is dropped, finish it so its tokens are still billed
+                        prompt_tokens, completion_tokens, stream_error, _ = stream_future.result()
+                        if stream_error:
+                            prompt_tokens, completion_tokens = 0, 0
+                        stream_future = None
+                    else:
+                        time_to_action.append(time.time() - call_start)
+                        logging.info(f'Time to first action: {time_to_action[-1]:.2f}s')
             else:
-                prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, client, messages, SYSTEM_PROMPT_TEXT_ONLY)
+                prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, llm, request_messages, system_instruction, prompt_cache, "main", step_model)
+            structured_reply = args.structured_output and apply_structured_reply(google_response)
+            if router and not gemini_call_error and google_response is not None:
+                escalation = router.check_reply(step_model, google_response)
+            if escalation:
+                # the fast reply is dropped, the strong model redoes the step
+                accumulate_prompt_token += prompt_tokens
+                accumulate_completion_token += completion_tokens
+                logging.info(f'Step escalated from {step_model} to {router.strong_model}: {escalation}')
+                step_model = router.strong_model
+                prompt_tokens, completion_tokens, gemini_call_error, google_response = call_gemini_api(args, llm, request_messages, system_instruction, prompt_cache, "main", step_model)
+                structured_reply = args.structured_output and apply_structured_reply(google_response)
+            if args.structured_output and google_response is not None:
+                # replies that did not fit the schema go through the regex path
+                structured_stats['structured' if structured_reply else 'fallback'] += 1
+            logging.info(f'Request latency ({step_model}): {time.time() - call_start:.2f}s')
 
             if gemini_call_error:
                 break
@@ -687,15 +1122,28 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                 accumulate_completion_token += completion_tokens
                 logging.info(f'Accumulate Prompt Tokens: {accumulate_prompt_token}; Accumulate Completion Tokens: {accumulate_completion_token}')
                 logging.info('API call complete...')
-            gemini_res = google_response.candidates[0].content.parts[0].text
-            messages.append({
+            if google_response is not None:
+                gemini_res = google_response.candidates[0].content.parts[0].text
+            model_msg = {
                 'role': 'model',
                 'parts': [
                     {'text': gemini_res}
                 ]
-            })
+            }
+            history.append(model_msg)
+            if stream_future is not None:
+                # the action is executed while the rest of the reply streams in
+                pending_stream = (stream_future, model_msg)
 
 
+            if tree_job is not None:
+                # the writer thread is done with the driver
+                try:
+                    tree_job.result()
+                except Exception:
+                    pass
+                tree_job = None
+
             # remove the rects on the website
             if (not args.text_only) and rects:
                 logging.info(f"Num of interactive elements: {len(rects)}")
@@ -711,12 +1159,19 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
             except AssertionError as e:
                 logging.error(e)
                 fail_obs = "Format ERROR: Both 'Thought' and 'Action' should be included in your reply."
+                structured_stats['format_error_retries'] += 1
+                if router:
+                    router.escalate('format_error')
                 continue
 
 
             """==========================================記錄此次迭代的錯誤信息和推理路徑==========================================="""
             bot_thought = re.split(pattern, gemini_res)[1].strip()
             chosen_action = re.split(pattern, gemini_res)[2].strip()
+            # the remaining Action lines of a plan run after the first one, as long as the page stays put
+            plan_actions = parse_action_plan(gemini_res, plan_actions_max)[1:] if plan_actions_max > 1 else []
+            if router:
+                router.observe_action(chosen_action)
             
             trajectory_info = f"Thought: {bot_thought}\nAction: {chosen_action}\n"
             error_info = f"Error: {error_exist}\nExplanation: {EGA_explanation}\n"
@@ -734,6 +1189,7 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
             fail_obs = ""
             pdf_obs = ""
             warn_obs = ""
+            step_url = driver_task.current_url if plan_actions else None
             # execute action
             try:
                 window_handle_task = driver_task.current_window_handle
@@ -785,7 +1241,7 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                                 pdf_obs = f"處理 PDF 文件時發生錯誤：{str(e)}"
                             
                             # pdf_obs = get_pdf_retrieval_ans_from_assistant(client, os.path.join(args.download_dir, pdf_file), task['ques'])
-                            shutil.copy(os.path.join(args.download_dir, pdf_file), task_dir)
+                            artifact_writer.submit(pdf_file, shutil.copy, os.path.join(args.download_dir, pdf_file), task_dir)
                             # pdf_obs = "You downloaded a PDF file, I ask the Assistant API to answer the task based on the PDF file and get the following response: " + pdf_obs
                             
                             
@@ -827,7 +1283,7 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
 
                 elif action_key == 'scroll':
                     if not args.text_only:
-                        exec_action_scroll(info, web_eles, driver_task, args, None)
+                        exec_action_scroll(info, web_eles, driver_task, args, None, full_page_scroll)
                     else:
                         exec_action_scroll(info, None, driver_task, args, obs_info)
 
@@ -841,7 +1297,7 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                     
                 elif action_key == 'generatetext':
                     logging.info('call generatetext Agent')
-                    pdf_obs = exec_action_generatetext(args, client, info, rag_system)
+                    pdf_obs = exec_action_generatetext(args, llm, info, rag_system)
                     
                     # 將摘要保存為 markdown 文件
                     try:
@@ -851,12 +1307,8 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                         md_path = os.path.join(task_dir, md_filename)
                         
                         # 寫入文件
-                        with open(md_path, 'w', encoding='utf-8') as f:
-                            f.write("# 文獻摘要\n\n")
-                            f.write(f"## 任務描述\n{info['parts']}\n\n")
-                            f.write("## 生成摘要\n")
-                            f.write(pdf_obs)
-                            
+                        artifact_writer.write_text(md_path, f"# 文獻摘要\n\n## 任務描述\n{info['parts']}\n\n## 生成摘要\n{pdf_obs}")
+
                         logging.info(f"摘要已保存至：{md_path}")
                         
                     except Exception as e:
@@ -883,9 +1335,80 @@ Before taking any action, analyze the provided [Manuals and QA pairs] as a whole
                     fail_obs = ""
                 time.sleep(2)
 
-        print_message(messages, task_dir)
+            if plan_actions and not fail_obs:
+                if action_key in PLAN_ACTION_KEYS:
+                    executed, plan_warn_obs, stop_reason = exec_action_plan(args, driver_task, plan_actions, web_eles if not args.text_only else None,
+                                                                            obs_info if args.text_only else None, step_url)
+                else:
+                    # a scroll, wait, back or search moved the page, the rest of the plan was made for the old one
+                    executed, plan_warn_obs, stop_reason = [], "", 'page_moved'
+                plan_stats['plans'] += 1
+                plan_stats['planned_actions'] += len(plan_actions) + 1
+                plan_stats['executed_actions'] += len(executed) + 1
+                warn_obs = plan_warn_obs or warn_obs
+                if args.trajectory:
+                    current_history += "".join(f"Action: {action}\n" for action in executed)
+                if stop_reason:
+                    plan_stats['aborted'][stop_reason] = plan_stats['aborted'].get(stop_reason, 0) + 1
+                    skipped = plan_actions[len(executed):]
+                    logging.info(f'Plan stopped ({stop_reason}) after {len(executed) + 1} of {len(plan_actions) + 1} actions')
+                    warn_obs = warn_obs + (" " if warn_obs else "") + (f"note: Your plan ran {len(executed) + 1} of {len(plan_actions) + 1} actions, these were not executed because "
+                                 f"{'they need a new observation' if stop_reason in ('not_plannable', 'bad_element', 'error') else 'the page changed'}: {'; '.join(skipped)}.")
+
+        if pending_stream is not None:
+            _, _, accumulate_prompt_token, accumulate_completion_token = drain_stream(pending_stream, accumulate_prompt_token, accumulate_completion_token)
+        if prompt_sizes:
+            logging.info(f'Prompt size: avg ~{sum(prompt_sizes) // len(prompt_sizes)} tokens, max ~{max(prompt_sizes)} over {len(prompt_sizes)} steps, '
+                         f'{history.clipped} observations clipped, {history.dropped} messages dropped')
+        logging.info(f'Reply parsing: {structured_stats}')
+        if plan_actions_max > 1:
+            logging.info(f'Action plans: {plan_stats}')
+        logging.info(f'Steps: {it}, wall time: {time.time() - task_start:.1f}s')
+        if time_to_action:
+            logging.info(f'Time to first action: avg {sum(time_to_action) / len(time_to_action):.2f}s, max {max(time_to_action):.2f}s over {len(time_to_action)} streamed calls')
+
+        # pending jobs may still use the driver
+        artifact_writer.flush()
+        artifact_writer.submit('interact_messages.json', print_message, history.transcript(), task_dir, args.pretty_json)
         driver_task.quit()
-        logging.info(f'Total cost: {accumulate_prompt_token / 1000 * 0.01 + accumulate_completion_token / 1000 * 0.03}')
+        # the task is not finished until all of its artifacts are on disk
+        artifact_writer.flush()
+        logging.info(f'Artifact writer: {artifact_writer.pop_stats()}')
+        if artifact_store:
+            logging.info(f'Artifact store: {artifact_store.pop_stats()}')
+        if args.skip_unchanged:
+            logging.info(f'Unchanged-page steps: {unchanged_steps}')
+        if args.speculative_EGA:
+            # dropped speculative calls are billed as well
+            for future in discarded_calls:
+                (prompt_tokens, completion_tokens, gemini_call_error, _), _ = future.result()
+                if not gemini_call_error:
+                    accumulate_prompt_token += prompt_tokens
+                    accumulate_completion_token += completion_tokens
+            logging.info(f'Speculative EGA: {speculative_hits} hits, {speculative_misses} misses, {speculative_saved:.2f}s saved')
+        if prompt_cache:
+            logging.info(f'Prompt cache: {prompt_cache.pop_stats()}')
+            prompt_cache.close()
+        if llm_cache:
+            logging.info(f'LLM response cache: {llm_cache.pop_stats()}')
+        llm_calls = ledger.price_records(llm.pop_telemetry())
+        artifact_writer.write_json(os.path.join(task_dir, 'llm_calls.json'), llm_calls, args.pretty_json)
+        task_cost = ledger.summarize(llm_calls, task['id'])
+        artifact_writer.write_json(os.path.join(task_dir, 'cost.json'), task_cost, True)
+        artifact_writer.write_json(os.path.join(result_dir, 'cost_rollup.json'), ledger.rollup(), True)
+        # the cost files are the last artifacts of the task
+        artifact_writer.flush()
+        logging.info(f'LLM calls: {len(llm_calls)}, retries: {sum(call["attempts"] - 1 for call in llm_calls)}, '
+                     f'hedged: {sum(call.get("hedged", False) for call in llm_calls)}, errors: {sum(call["status"] != "ok" for call in llm_calls)}')
+        if router:
+            logging.info(f'Model routing: {router.pop_stats()}, per model: {summarize_calls_by_model(llm_calls)}')
+        cost_by_kind = ', '.join('{} {}'.format(kind, bucket['cost_usd']) for kind, bucket in task_cost['by_kind'].items())
+        logging.info(f'Total cost: {task_cost["total_cost_usd"]} USD ({cost_by_kind})')
+
+    artifact_writer.close()
+    if llm_executor:
+        llm_executor.shutdown()
+    shutil.rmtree(payload_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,34 @@
+from conversation_history import ConversationHistory
+
+
+def user_msg(step, observation="x" * 400):
+    return {'role': 'user', 'parts': [{'text': f"Thought/Action of step {step}\nObservation: {observation}"},
+                                      {'image_ref': {'blob': f"blobs/{step}.png", 'mime_type': 'image/png'}}]}
+
+
+def model_msg(step):
+    return {'role': 'model', 'parts': [{'text': f"Thought: step {step}\nAction: Click [{step}]"}]}
+
+
+def test_budgeted_history_keeps_every_turn_in_the_transcript():
+    history = ConversationHistory(max_observations=1, token_budget=600)
+    appended = []
+    for step in range(10):
+        for msg in (user_msg(step), model_msg(step)):
+            history.append(msg)
+            appended.append(msg)
+
+    # the prompt is cut down to the budget ...
+    assert history.dropped > 0
+    assert len(history.messages()) < len(appended)
+    # ... the transcript is not
+    assert history.transcript() == appended
+
+
+def test_transcript_follows_replace_last():
+    history = ConversationHistory(max_observations=3)
+    history.append(user_msg(0))
+    replaced = user_msg(0, observation="with the EGA explanation")
+    history.replace_last(replaced)
+    assert history.transcript() == [replaced]
+    assert history.messages() == [replaced]
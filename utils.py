@@ -1,30 +1,98 @@
 import base64
+import io
+import math
 import re
 import os
-import json
 import time
 import logging
 import numpy as np
 from PIL import Image
 from utils_webarena import fetch_browser_info, fetch_page_accessibility_tree,\
-                    parse_accessibility_tree, clean_accesibility_tree
+                    parse_accessibility_tree, clean_accesibility_tree, compress_accessibility_tree
+from utils_json import dump_json_file
 from google.genai import types
-def resize_image(image_path):
-    image = Image.open(image_path)
-    width, height = image.size
 
-    if min(width, height) < 512:
+
+# Image encoding presets for model input. max_side 0 keeps the original size.
+# SoM labels are 12px, keep the scale at 2/3 or above or they become unreadable.
+IMAGE_POLICIES = {
+    "png": {"max_side": 0, "format": "png", "quality": None, "grayscale": False},
+    "webp": {"max_side": 1280, "format": "webp", "quality": 80, "grayscale": False},
+    "jpeg": {"max_side": 1280, "format": "jpeg", "quality": 75, "grayscale": False},
+    "jpeg_gray": {"max_side": 1280, "format": "jpeg", "quality": 75, "grayscale": True},
+}
+
+
+def resize_image(image, max_side):
+    """Downscale a PIL image so that its longer side is at most max_side"""
+    width, height = image.size
+    if not max_side or max(width, height) <= max_side:
         return image
-    elif width < height:
-        new_width = 512
-        new_height = int(height * (new_width / width))
+    scale = max_side / max(width, height)
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(new_size, Image.LANCZOS)
+
+
+def estimate_image_tokens(width, height):
+    """Gemini image token cost: 258 tokens for images up to 384x384, otherwise
+    258 tokens per 768x768 tile"""
+    if width <= 384 and height <= 384:
+        return 258
+    return math.ceil(width / 768) * math.ceil(height / 768) * 258
+
+
+def estimate_policy_tokens(width, height, policy="png", max_side=None):
+    """Estimated image tokens of a width x height screenshot after encode_screenshot"""
+    if max_side is None:
+        max_side = IMAGE_POLICIES[policy]["max_side"]
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+    return estimate_image_tokens(width, height)
+
+
+def encode_screenshot(png_bytes, policy="png", max_side=None, quality=None, grayscale=None):
+    """Encode a PNG screenshot for model input according to an image policy.
+
+    `max_side`, `quality` and `grayscale` override the preset values.
+    Returns a dict with the base64 data, the encoded bytes (`raw`), mime type,
+    size and estimated tokens.
+    """
+    settings = dict(IMAGE_POLICIES[policy])
+    if max_side is not None:
+        settings["max_side"] = max_side
+    if quality is not None:
+        settings["quality"] = quality
+    if grayscale is not None:
+        settings["grayscale"] = grayscale
+
+    image = Image.open(io.BytesIO(png_bytes))
+    original_size = image.size
+    if settings["format"] == "png" and not settings["max_side"] and not settings["grayscale"]:
+        data = png_bytes
     else:
-        new_height = 512
-        new_width = int(width * (new_height / height))
+        image = resize_image(image, settings["max_side"])
+        image = image.convert("L") if settings["grayscale"] else image.convert("RGB")
+        buffer = io.BytesIO()
+        save_kwargs = {}
+        if settings["format"] in ("jpeg", "webp"):
+            save_kwargs["quality"] = settings["quality"]
+        elif settings["format"] == "png":
+            save_kwargs["optimize"] = True
+        image.save(buffer, format=settings["format"].upper(), **save_kwargs)
+        data = buffer.getvalue()
 
-    resized_image = image.resize((new_width, new_height), Image.LANCZOS)
-    resized_image.save(image_path)
-    # return resized_image
+    width, height = image.size
+    return {
+        "data": base64.b64encode(data).decode('utf-8'),
+        "raw": data,
+        "mime_type": f"image/{settings['format']}",
+        "original_size": original_size,
+        "size": (width, height),
+        "original_bytes": len(png_bytes),
+        "bytes": len(data),
+        "tokens": estimate_image_tokens(width, height),
+    }
 
 
 # base64 encoding
@@ -35,7 +103,13 @@ def encode_image(image_path):
 
 
 # interact with webpage and add rectangles on elements
-def get_web_element_rect(browser, fix_color=True):
+def get_web_element_rect(browser, fix_color=True, full_page=False):
+    """Label the interactive elements with set-of-mark boxes.
+
+    With `full_page`, elements below and above the viewport are labelled too:
+    the boxes are placed in document coordinates, so the labels stay valid on
+    every tile returned by `capture_page_tiles`.
+    """
     if fix_color:
         selected_function = "getFixedColor"
         # color_you_like = '#5210da'
@@ -47,12 +121,20 @@ def get_web_element_rect(browser, fix_color=True):
 
         function markPage() {
             var bodyRect = document.body.getBoundingClientRect();
+            // full page: rects in document coordinates, clipped to the document instead of the viewport
+            var fullPage = FULL_PAGE;
+            var offsetX = fullPage ? window.scrollX : 0;
+            var offsetY = fullPage ? window.scrollY : 0;
 
             var items = Array.prototype.slice.call(
                 document.querySelectorAll('*')
             ).map(function(element) {
                 var vw = Math.max(document.documentElement.clientWidth || 0, window.innerWidth || 0);
                 var vh = Math.max(document.documentElement.clientHeight || 0, window.innerHeight || 0);
+                if (fullPage) {
+                    vw = document.documentElement.scrollWidth;
+                    vh = Math.max(document.documentElement.scrollHeight, document.body.scrollHeight);
+                }
                 
                 //  element.getClientRects() 返回一個 ClientRectList 對象,它是一個類數組(array-like)的集合,包含元素的所有邊界矩形(DOMRect 對象)。
                 // ClientRectList 不是真正的數組，因此不能直接使用數組的方法（如 map、filter 等）。
@@ -63,15 +145,19 @@ def get_web_element_rect(browser, fix_color=True):
                 //  如果中心點所在的元素是當前元素或其子元素，則保留該矩形。
                 var center_x = bb.left + bb.width / 2;
                 var center_y = bb.top + bb.height / 2;
+                // elementFromPoint only hit-tests inside the viewport
+                if (fullPage && (center_x < 0 || center_y < 0 || center_x > window.innerWidth || center_y > window.innerHeight)) {
+                    return bb.width > 0 && bb.height > 0;
+                }
                 var elAtCenter = document.elementFromPoint(center_x, center_y);
 
                 return elAtCenter === element || element.contains(elAtCenter) 
                 }).map(bb => {
                 const rect = {
-                    left: Math.max(0, bb.left),
-                    top: Math.max(0, bb.top),
-                    right: Math.min(vw, bb.right),
-                    bottom: Math.min(vh, bb.bottom)
+                    left: Math.max(0, bb.left + offsetX),
+                    top: Math.max(0, bb.top + offsetY),
+                    right: Math.min(vw, bb.right + offsetX),
+                    bottom: Math.min(vh, bb.bottom + offsetY)
                 };
                 return {
                     ...rect,
@@ -138,7 +224,7 @@ def get_web_element_rect(browser, fix_color=True):
                 newElement = document.createElement("div");
                 var borderColor = COLOR_FUNCTION(index);
                 newElement.style.outline = `2px dashed ${borderColor}`;
-                newElement.style.position = "fixed";
+                newElement.style.position = fullPage ? "absolute" : "fixed";
                 newElement.style.left = bbox.left + "px";
                 newElement.style.top = bbox.top + "px";
                 newElement.style.width = bbox.width + "px";
@@ -163,7 +249,7 @@ def get_web_element_rect(browser, fix_color=True):
                 label.style.borderRadius = "2px";
                 newElement.appendChild(label);
                 
-                document.body.appendChild(newElement);
+                (fullPage ? document.documentElement : document.body).appendChild(newElement);
                 labels.push(newElement);
                 // item.element.setAttribute("-ai-label", label.textContent);
                 });
@@ -177,7 +263,7 @@ def get_web_element_rect(browser, fix_color=True):
             // For the second way
             return [labels, items]
         }
-        return markPage();""".replace("COLOR_FUNCTION", selected_function)
+        return markPage();""".replace("COLOR_FUNCTION", selected_function).replace("FULL_PAGE", "true" if full_page else "false")
     rects, items_raw = browser.execute_script(js_script)
 
     # format_ele_text = [f"[{web_ele_id}]: \"{items_raw[web_ele_id]['text']}\";" for web_ele_id in range(len(items_raw)) if items_raw[web_ele_id]['text'] ]
@@ -215,6 +301,26 @@ def get_web_element_rect(browser, fix_color=True):
     return rects, [web_ele['element'] for web_ele in items_raw], format_ele_text
 
 
+
+def capture_page_tiles(browser, max_tiles):
+    """Capture the page from the current scroll position downwards in
+    viewport-sized tiles through CDP, without scrolling the window.
+
+    Returns a list of (top, height, png_bytes) in document coordinates, and
+    the page height.
+    """
+    scroll_y, tile_height, page_width, page_height = browser.execute_script(
+        "return [window.scrollY, window.innerHeight, document.documentElement.clientWidth,"
+        " Math.max(document.documentElement.scrollHeight, document.body.scrollHeight)];")
+    tiles = []
+    top = scroll_y
+    while len(tiles) < max_tiles and top < page_height:
+        clip = {"x": 0, "y": top, "width": page_width, "height": min(tile_height, page_height - top), "scale": 1}
+        result = browser.execute_cdp_cmd("Page.captureScreenshot", {"format": "png", "captureBeyondViewport": True, "clip": clip})
+        tiles.append((top, clip["height"], base64.b64decode(result["data"])))
+        top += tile_height
+    return tiles, page_height
+
 def extract_information(text):
     patterns = {
         "click": r"Click \[?(\d+)\]?",
@@ -262,58 +368,7 @@ def clip_message(msg, max_img_num):
     return clipped_msg
 
 
-def clip_message_and_obs(msg, max_img_num):
-    clipped_msg = []
-    img_num = 0
-    for idx in range(len(msg)):
-        curr_msg = msg[len(msg) - 1 - idx]
-        if curr_msg['role'] != 'user':
-            clipped_msg = [curr_msg] + clipped_msg
-        else:
-            if type(curr_msg['parts']) == str:
-                clipped_msg = [curr_msg] + clipped_msg
-            elif img_num < max_img_num:
-                img_num += 1
-                clipped_msg = [curr_msg] + clipped_msg
-            else:
-                msg_no_pdf = curr_msg['parts'][0]["text"].split("Observation:")[0].strip() + "Observation: A screenshot and some texts. (Omitted in context.)"
-                msg_pdf = curr_msg['parts'][0]["text"].split("Observation:")[0].strip() + "Observation: A screenshot, a PDF file and some texts. (Omitted in context.)"
-                curr_msg_clip = {
-                    'role': curr_msg['role'],
-                    'parts': [
-                        {'text': msg_no_pdf if "You downloaded a PDF file" not in curr_msg['parts'] else msg_pdf}
-                    ]
-                }
-                clipped_msg = [curr_msg_clip] + clipped_msg
-    return clipped_msg
-
-
-def clip_message_and_obs_text_only(msg, max_tree_num):
-    clipped_msg = []
-    tree_num = 0
-    for idx in range(len(msg)):
-        curr_msg = msg[len(msg) - 1 - idx]
-        if curr_msg['role'] != 'user':
-            clipped_msg = [curr_msg] + clipped_msg
-        else:
-            if tree_num < max_tree_num:
-                tree_num += 1
-                clipped_msg = [curr_msg] + clipped_msg
-            else:
-                msg_no_pdf = curr_msg['parts'].split("Observation:")[0].strip() + "Observation: An accessibility tree. (Omitted in context.)"
-                msg_pdf = curr_msg['parts'].split("Observation:")[0].strip() + "Observation: An accessibility tree and a PDF file. (Omitted in context.)"
-                curr_msg_clip = {
-                    'role': curr_msg['role'],
-                    # 'parts': msg_no_pdf if "You downloaded a PDF file" not in curr_msg['parts'] else msg_pdf
-                    'parts': [
-                        {'text': msg_no_pdf if "You downloaded a PDF file" not in curr_msg['parts'] else msg_pdf}
-                    ]
-                }
-                clipped_msg = [curr_msg_clip] + clipped_msg
-    return clipped_msg
-
-
-def print_message(json_object, save_dir=None):
+def print_message(json_object, save_dir=None, pretty_json=False):
     remove_b64code_obj = []
     for obj in json_object:
         if obj['role'] != 'user':
@@ -338,19 +393,19 @@ def print_message(json_object, save_dir=None):
                 logging.info(print_obj)
                 remove_b64code_obj.append(print_obj)
     if save_dir:
-        with open(os.path.join(save_dir, 'interact_messages.json'), 'w', encoding='utf-8') as fw:
-            json.dump(remove_b64code_obj, fw, indent=2)
+        dump_json_file(remove_b64code_obj, os.path.join(save_dir, 'interact_messages.json'), pretty=pretty_json)
     # return remove_b64code_obj
 
 
-def get_webarena_accessibility_tree(browser, save_file=None):
+def get_webarena_accessibility_tree(browser, save_file=None, token_budget=0, pretty_json=False):
     browser_info = fetch_browser_info(browser)
     accessibility_tree = fetch_page_accessibility_tree(browser_info, browser, current_viewport_only=True)
     content, obs_nodes_info = parse_accessibility_tree(accessibility_tree)
     content = clean_accesibility_tree(content)
+    if token_budget:
+        content = compress_accessibility_tree(content, token_budget)
     if save_file:
-        with open(save_file + '.json', 'w', encoding='utf-8') as fw:
-            json.dump(obs_nodes_info, fw, indent=2)
+        dump_json_file(obs_nodes_info, save_file + '.json', pretty=pretty_json)
         with open(save_file + '.txt', 'w', encoding='utf-8') as fw:
             fw.write(content)
 
@@ -359,11 +414,14 @@ def get_webarena_accessibility_tree(browser, save_file=None):
 
 
 def compare_images(img1_path, img2_path):
-    img1 = Image.open(img1_path)
-    img2 = Image.open(img2_path)
+    img1 = Image.open(img1_path).convert('RGB')
+    img2 = Image.open(img2_path).convert('RGB')
+    if img1.size != img2.size:
+        return float('inf')
 
-    img1_array = np.asarray(img1)
-    img2_array = np.asarray(img2)
+    # widen before subtracting, uint8 differences wrap around
+    img1_array = np.asarray(img1, dtype=np.int32)
+    img2_array = np.asarray(img2, dtype=np.int32)
 
     difference = np.abs(img1_array - img2_array)
 
@@ -372,6 +430,81 @@ def compare_images(img1_path, img2_path):
     return total_difference
 
 
+def screenshot_thumbnail(png_bytes, size=(64, 36)):
+    """Small grayscale copy of a screenshot for cheap change detection"""
+    image = Image.open(io.BytesIO(png_bytes)).convert('L')
+    return np.asarray(image.resize(size, Image.BOX), dtype=np.int16)
+
+
+def screenshots_unchanged(prev_thumb, curr_thumb, max_pixel_diff=12):
+    """True when no thumbnail pixel moved by more than max_pixel_diff (0-255).
+    A thumbnail pixel covers about 30x30 screen pixels, so a dropdown or a
+    modal shows up while anti-aliasing noise does not."""
+    if prev_thumb is None or curr_thumb is None or prev_thumb.shape != curr_thumb.shape:
+        return False
+    return int(np.abs(prev_thumb - curr_thumb).max()) <= max_pixel_diff
+
+
+def find_changed_region(prev_png, curr_png, grid=(192, 108), pixel_threshold=24, padding=32, max_area_ratio=0.6):
+    """Bounding box (left, top, right, bottom) of what changed between two
+    screenshots, in screenshot pixels.
+
+    The diff runs on a grid x grid grayscale downsample (10px cells at
+    1920x1068). Returns None when nothing changed, when the sizes differ, or
+    when the change covers more than max_area_ratio of the frame (e.g. after a
+    navigation), in which case the full frame should be sent.
+    """
+    prev_image = Image.open(io.BytesIO(prev_png))
+    curr_image = Image.open(io.BytesIO(curr_png))
+    if prev_image.size != curr_image.size:
+        return None
+    width, height = curr_image.size
+    prev_small = np.asarray(prev_image.convert('L').resize(grid, Image.BOX), dtype=np.int16)
+    curr_small = np.asarray(curr_image.convert('L').resize(grid, Image.BOX), dtype=np.int16)
+    changed = np.abs(prev_small - curr_small) > pixel_threshold
+    if not changed.any():
+        return None
+
+    rows = np.flatnonzero(changed.any(axis=1))
+    cols = np.flatnonzero(changed.any(axis=0))
+    cell_width = width / grid[0]
+    cell_height = height / grid[1]
+    left = max(0, int(cols[0] * cell_width) - padding)
+    top = max(0, int(rows[0] * cell_height) - padding)
+    right = min(width, int((cols[-1] + 1) * cell_width) + padding)
+    bottom = min(height, int((rows[-1] + 1) * cell_height) + padding)
+    if (right - left) * (bottom - top) > max_area_ratio * width * height:
+        return None
+    return left, top, right, bottom
+
+
+def crop_screenshot(png_bytes, box):
+    image = Image.open(io.BytesIO(png_bytes))
+    buffer = io.BytesIO()
+    image.crop(box).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def get_page_state_hash(browser):
+    """Hash of the visible text, form values and element count of the page.
+    Call it before the set-of-mark labels are added."""
+    return browser.execute_script("""
+        var state = document.body ? document.body.innerText : '';
+        var fields = document.querySelectorAll('input, textarea, select');
+        for (var i = 0; i < fields.length; i++) {
+            state += '\\u0000' + fields[i].value + (fields[i].checked ? '1' : '0');
+        }
+        state += '\\u0000' + document.getElementsByTagName('*').length;
+        // FNV-1a
+        var hash = 0x811c9dc5;
+        for (var i = 0; i < state.length; i++) {
+            hash ^= state.charCodeAt(i);
+            hash = Math.imul(hash, 0x01000193);
+        }
+        return (hash >>> 0).toString(16) + ':' + state.length;
+    """)
+
+
 def get_pdf_retrieval_ans_from_assistant(client, pdf_path, task):
     # print("You download a PDF file that will be retrieved using the Assistant API.")
     logging.info("You download a PDF file that will be retrieved using the Assistant API.")
@@ -418,13 +551,13 @@ def get_pdf_retrieval_ans_from_assistant(client, pdf_path, task):
     return messages_text
 
 
-def get_pdf_retrieval_ans_from_rag(args, client, task, rag_system):
+def get_pdf_retrieval_ans_from_rag(args, llm, task, rag_system):
     """
     使用 Gemini 嵌入模型和 RAG 系統生成 PDF 摘要
     
     Args:
         args: 命令行參數
-        client: Gemini API 客戶端
+        llm: Gemini 的 LLMClient
         task: 用戶的查詢任務
         rag_system: RAG 系統實例
         
@@ -458,8 +591,9 @@ def get_pdf_retrieval_ans_from_rag(args, client, task, rag_system):
 - 針對每套技術解決的問題都要全面的介紹
 """
         
-        # 直接使用 Gemini SDK 生成摘要
-        response = client.models.generate_content(
+        # 透過共用的 LLMClient 生成摘要（含重試與逾時）
+        response = llm.call(
+            "rag_summary",
             model=args.api_model,
             contents=[summary_prompt],
             config=types.GenerateContentConfig(
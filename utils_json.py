@@ -0,0 +1,66 @@
+"""JSON helpers for CDP payloads and result artifacts.
+
+orjson is used when it is installed, otherwise everything falls back to the
+standard library. Output is compact unless `pretty=True` is passed.
+"""
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def json_backend() -> str:
+    return "orjson" if orjson is not None else "json"
+
+
+def json_dumps_bytes(obj: Any, pretty: bool = False) -> bytes:
+    """Serialize `obj` to UTF-8 encoded JSON"""
+    if orjson is not None:
+        option = _ORJSON_OPTIONS | orjson.OPT_INDENT_2 if pretty else _ORJSON_OPTIONS
+        return orjson.dumps(obj, option=option)
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_dumps(obj: Any, pretty: bool = False) -> str:
+    return json_dumps_bytes(obj, pretty).decode("utf-8")
+
+
+def json_loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json_file(obj: Any, path: str, pretty: bool = False) -> None:
+    with open(path, "wb") as fw:
+        fw.write(json_dumps_bytes(obj, pretty))
+
+
+def load_json_file(path: str) -> Any:
+    with open(path, "rb") as fr:
+        return json_loads(fr.read())
+
+
+def install_fast_cdp_decoder() -> bool:
+    """Decode WebDriver responses (including CDP results such as the full
+    accessibility tree and DOM snapshots) with the fast backend.
+
+    Selenium parses every response through `selenium.webdriver.remote.utils.load_json`,
+    which is replaced here. orjson raises a subclass of ValueError on bad
+    input, which is what selenium expects. Returns False when orjson is not
+    installed and nothing was changed.
+    """
+    if orjson is None:
+        return False
+    from selenium.webdriver.remote import utils as remote_utils
+
+    remote_utils.load_json = orjson.loads
+    return True
@@ -1,6 +1,9 @@
 from typing import Any, TypedDict
+import hashlib
 import re
 
+import numpy as np
+
 
 class AccessibilityTreeNode(TypedDict):
     nodeId: str
@@ -46,6 +49,42 @@ AccessibilityTree = list[AccessibilityTreeNode]
 
 IN_VIEWPORT_RATIO_THRESHOLD = 0.6
 
+# roles the agent can act on, kept first when the tree has to be cut down
+INTERACTIVE_ROLES = (
+    "button",
+    "link",
+    "textbox",
+    "searchbox",
+    "combobox",
+    "listbox",
+    "option",
+    "checkbox",
+    "radio",
+    "switch",
+    "slider",
+    "spinbutton",
+    "menuitem",
+    "menuitemcheckbox",
+    "menuitemradio",
+    "tab",
+    "treeitem",
+)
+
+# structural roles that carry useful context but are not actionable
+LANDMARK_ROLES = (
+    "heading",
+    "RootWebArea",
+    "dialog",
+    "alertdialog",
+    "alert",
+    "form",
+    "search",
+    "main",
+    "navigation",
+)
+
+ACTREE_LINE_PATTERN = re.compile(r"^(\t*)\[([^\]]+)\] (\S+)(.*)$")
+
 
 
 def fetch_browser_info(
@@ -109,31 +148,41 @@ def get_element_in_viewport_ratio(
     height: float,
     config: BrowserConfig,
 ) -> float:
-    elem_right_bound = elem_left_bound + width
-    elem_lower_bound = elem_top_bound + height
+    bounds = np.array([[elem_left_bound, elem_top_bound, width, height]])
+    return float(get_elements_in_viewport_ratio(bounds, config)[0])
 
-    win_left_bound = 0
-    win_right_bound = config["win_width"]
-    win_top_bound = 0
-    win_lower_bound = config["win_height"]
+
+def get_elements_in_viewport_ratio(
+    bounds: np.ndarray,
+    config: BrowserConfig,
+) -> np.ndarray:
+    """Fraction of each element's area inside the viewport.
+
+    `bounds` is an (N, 4) array of [x, y, width, height] rows. Rows with a
+    zero or NaN area get a ratio of 0.
+    """
+    left = bounds[:, 0]
+    top = bounds[:, 1]
+    width = bounds[:, 2]
+    height = bounds[:, 3]
 
     # Compute the overlap in x and y axes
-    overlap_width = max(
+    overlap_width = np.clip(
+        np.minimum(left + width, config["win_width"]) - np.maximum(left, 0),
         0,
-        min(elem_right_bound, win_right_bound)
-        - max(elem_left_bound, win_left_bound),
+        None,
     )
-    overlap_height = max(
+    overlap_height = np.clip(
+        np.minimum(top + height, config["win_height"]) - np.maximum(top, 0),
         0,
-        min(elem_lower_bound, win_lower_bound)
-        - max(elem_top_bound, win_top_bound),
+        None,
     )
 
-    # Compute the overlap area
-    ratio = overlap_width * overlap_height / width * height
-    return ratio
-
-
+    # Compute the overlap area relative to the element area
+    area = width * height
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = overlap_width * overlap_height / area
+    return np.where(area > 0, ratio, 0.0)
 
 
 def get_bounding_client_rect(
@@ -169,6 +218,32 @@ def get_bounding_client_rect(
         return {"result": {"subtype": "error"}}
 
 
+def node_hit_at_point(browser, backend_node_id: str, x: float, y: float) -> bool:
+    """True when the element at (x, y) is the node or inside it, i.e. nothing covers the node there"""
+    try:
+        remote_object = browser.execute_cdp_cmd(
+            "DOM.resolveNode", {"backendNodeId": int(backend_node_id)}
+        )
+        response = browser.execute_cdp_cmd(
+            "Runtime.callFunctionOn",
+            {
+                "objectId": remote_object["object"]["objectId"],
+                "functionDeclaration": """
+                    function(x, y) {
+                        var node = this.nodeType == 3 ? this.parentNode : this;
+                        var hit = document.elementFromPoint(x, y);
+                        return !!hit && (hit === node || node.contains(hit));
+                    }
+                """,
+                "arguments": [{"value": x}, {"value": y}],
+                "returnByValue": True,
+            },
+        )
+        return bool(response["result"].get("value"))
+    except:
+        return False
+
+
 def fetch_page_accessibility_tree(
     info: BrowserInfo,
     browser,
@@ -248,28 +323,19 @@ def fetch_page_accessibility_tree(
             accessibility_tree[node_cursor]["parentId"] = "[REMOVED]"
 
         config = info["config"]
-        for node in accessibility_tree:
-            if not node["union_bound"]:
-                remove_node_in_graph(node)
-                continue
-
-            [x, y, width, height] = node["union_bound"]
-
-            # invisible node
-            if width == 0 or height == 0:
-                remove_node_in_graph(node)
-                continue
-
-            in_viewport_ratio = get_element_in_viewport_ratio(
-                elem_left_bound=float(x),
-                elem_top_bound=float(y),
-                width=float(width),
-                height=float(height),
-                config=config,
-            )
-
-            if in_viewport_ratio < IN_VIEWPORT_RATIO_THRESHOLD:
-                remove_node_in_graph(node)
+        # nodes without bounds get NaN and are removed with the invisible ones
+        bounds = np.array(
+            [
+                node["union_bound"] if node["union_bound"] else [np.nan] * 4
+                for node in accessibility_tree
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+        in_viewport_ratio = get_elements_in_viewport_ratio(bounds, config)
+        remove_mask = ~(in_viewport_ratio >= IN_VIEWPORT_RATIO_THRESHOLD)
+
+        for cursor in np.flatnonzero(remove_mask):
+            remove_node_in_graph(accessibility_tree[cursor])
 
         accessibility_tree = [
             node
@@ -387,3 +453,115 @@ def clean_accesibility_tree(tree_str: str) -> str:
             clean_lines.append(line)
 
     return "\n".join(clean_lines)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English text)"""
+    return (len(text) + 3) // 4
+
+
+def compress_accessibility_tree(
+    tree_str: str,
+    token_budget: int,
+    list_keep: int = 5,
+) -> str:
+    """Compress a parsed accessibility tree to fit in `token_budget` tokens.
+
+    Lines are never rewritten, so every `[id]` that survives still resolves
+    through `obs_nodes_info`. The tree is reduced in three passes:
+    1. drop non-interactive lines whose content (without the id) was already
+       seen anywhere in the tree
+    2. collapse runs of more than `list_keep` sibling subtrees sharing the same
+       role into the first `list_keep` plus a one-line summary
+    3. if still over budget, keep interactive lines first, then landmarks and
+       headings, then the rest, each group in document order
+    """
+    if token_budget <= 0 or estimate_tokens(tree_str) <= token_budget:
+        return tree_str
+
+    # (depth, role, line); role is None for lines that do not carry an id
+    lines: list[tuple[int, str | None, str]] = []
+    seen_content: set[bytes] = set()
+    for line in tree_str.split("\n"):
+        match = ACTREE_LINE_PATTERN.match(line)
+        if not match:
+            lines.append((len(line) - len(line.lstrip("\t")), None, line))
+            continue
+        indent, _, role, rest = match.groups()
+        if role not in INTERACTIVE_ROLES:
+            digest = hashlib.blake2b(
+                f"{role}{rest}".encode("utf-8"), digest_size=16
+            ).digest()
+            if digest in seen_content:
+                continue
+            seen_content.add(digest)
+        lines.append((len(indent), role, line))
+
+    # collapse long homogeneous sibling runs
+    collapsed: list[tuple[int, str | None, str]] = []
+    # (depth, role, number of sibling subtrees seen, number dropped)
+    runs: list[list] = []
+
+    def close_runs(depth: int) -> None:
+        while runs and runs[-1][0] >= depth:
+            run_depth, run_role, _, dropped = runs.pop()
+            if dropped:
+                collapsed.append((
+                    run_depth,
+                    None,
+                    "\t" * run_depth + f"... {dropped} more {run_role} items omitted",
+                ))
+
+    skip_depth = None
+    for depth, role, line in lines:
+        if skip_depth is not None:
+            if depth > skip_depth:
+                continue
+            skip_depth = None
+        if role is None:
+            close_runs(depth + 1)
+            collapsed.append((depth, role, line))
+            continue
+        close_runs(depth + 1)
+        if runs and runs[-1][0] == depth and runs[-1][1] == role:
+            runs[-1][2] += 1
+        else:
+            close_runs(depth)
+            runs.append([depth, role, 1, 0])
+        if runs[-1][2] > list_keep:
+            runs[-1][3] += 1
+            skip_depth = depth
+            continue
+        collapsed.append((depth, role, line))
+    close_runs(0)
+
+    result = "\n".join(line for _, _, line in collapsed)
+    if estimate_tokens(result) <= token_budget:
+        return result
+
+    # hard budget: greedily keep the highest priority lines
+    def priority(role: str | None) -> int:
+        if role in INTERACTIVE_ROLES:
+            return 0
+        if role in LANDMARK_ROLES:
+            return 1
+        return 2
+
+    order = sorted(
+        range(len(collapsed)), key=lambda i: (priority(collapsed[i][1]), i)
+    )
+    kept: set[int] = set()
+    # reserve room for the trailing note
+    used = estimate_tokens("... 000000 lines omitted to fit the token budget")
+    for i in order:
+        cost = estimate_tokens(collapsed[i][2]) + 1
+        if used + cost > token_budget:
+            continue
+        kept.add(i)
+        used += cost
+
+    kept_lines = [collapsed[i][2] for i in sorted(kept)]
+    omitted = len(collapsed) - len(kept_lines)
+    if omitted:
+        kept_lines.append(f"... {omitted} lines omitted to fit the token budget")
+    return "\n".join(kept_lines)